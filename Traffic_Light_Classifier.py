@@ -56,6 +56,7 @@
 
 import cv2 # computer vision library
 import helpers # helper functions
+import batch_features # batched features and image geometry
 
 import random
 import numpy as np
@@ -174,12 +175,16 @@ plt.imshow(selected_image)
 # In[5]:
 
 
+# Size of the standard images. 32x32 by default; smaller sizes are faster and larger
+# ones keep more detail (see resolution_sweep.py to compare them)
+STANDARD_SIZE = batch_features.STANDARD_SIZE
+
 # This function should take in an RGB image and return a new, standardized version
 def standardize_input(image):
     
     ## TODO: Resize image and pre-process so that all "standard" images are the same size  
     standard_im = np.copy(image)
-    standard_im = cv2.resize(standard_im, (32,32))
+    standard_im = cv2.resize(standard_im, (STANDARD_SIZE,STANDARD_SIZE))
     
     return standard_im
     
@@ -391,8 +396,9 @@ def create_feature(rgb_image):
     masked_image[mask != 0] = [0,0,0]
 
     # Crop the image to focus only on the traffic lights and delete the aread around it
-    crop_x = 8
-    crop_y = 3
+    # The crop and the rows of each light scale with the size of the standard image
+    # (crop_x = 8, crop_y = 3 and rows 2:11, 11:19, 19:27 for 32x32 images)
+    crop_x, crop_y, band_rows = batch_features.band_geometry(rgb_image.shape[0], rgb_image.shape[1])
     cropped_image = masked_image[crop_y:-crop_y, crop_x:-crop_x,:]
 
     height_cropped_image = cropped_image.shape[0]
@@ -402,9 +408,10 @@ def create_feature(rgb_image):
     # 1st section - Red Light
     # 2nd section - Yellow Light
     # 3rd section - Green Light
-    cropped_image_red_light = cropped_image[2:11,0:width_cropped_image,:]
-    cropped_image_yellow_light = cropped_image[11:19,0:width_cropped_image,:]
-    cropped_image_green_light = cropped_image[19:27,0:width_cropped_image,:]
+    (red_start, red_end), (yellow_start, yellow_end), (green_start, green_end) = band_rows
+    cropped_image_red_light = cropped_image[red_start:red_end,0:width_cropped_image,:]
+    cropped_image_yellow_light = cropped_image[yellow_start:yellow_end,0:width_cropped_image,:]
+    cropped_image_green_light = cropped_image[green_start:green_end,0:width_cropped_image,:]
 
     # Calculate the area of each sections of the image
     area_red_crop_image = area(cropped_image_red_light.shape[0], cropped_image.shape[1])
@@ -0,0 +1,110 @@
+# Array-aware versions of the label tests
+#
+# The notebook tests check Python-list labels one item at a time. These tests
+# take the same inputs, but also NumPy arrays of class indices (N,) or one-hot
+# labels (N, 3), and check everything with vectorized operations so million
+# image outputs are validated in one pass.
+#
+# Example:
+#   import array_tests
+#   tests = array_tests.ArrayTests()
+#   tests.test_one_hot(one_hot_encode)
+#   tests.test_labels(predicted_classes)                # (N,) or (N, 3) array
+#   tests.test_red_as_green(MISCLASSIFIED)              # list of tuples, as before
+#   tests.test_red_as_green((predicted, true_labels))   # or a pair of arrays
+
+import unittest
+
+import numpy as np
+
+from test_output import print_fail, print_pass
+
+NUM_CLASSES = 3
+RED = 0
+GREEN = 2
+
+
+# Check labels and return them as an (N,) array of class indices. Accepts a
+# list of one-hot lists, an (N, 3) one-hot array or an (N,) index array.
+# Raises ValueError describing the first problem found.
+def as_class_indices(labels, num_classes=NUM_CLASSES):
+    labels = np.asarray(labels)
+    if labels.ndim == 1:
+        if labels.size and not np.issubdtype(labels.dtype, np.integer):
+            raise ValueError('Class indices must be integers, got ' + str(labels.dtype))
+        invalid = np.flatnonzero((labels < 0) | (labels >= num_classes))
+        if len(invalid):
+            raise ValueError('Label %d is %s, expected a class index in [0, %d)'
+                             % (invalid[0], labels[invalid[0]], num_classes))
+        return labels
+
+    if labels.ndim != 2 or labels.shape[1] != num_classes:
+        raise ValueError('Expected labels of shape (N,) or (N, %d), got %s'
+                         % (num_classes, labels.shape))
+    invalid = np.flatnonzero(((labels != 0) & (labels != 1)).any(axis=1) | (labels.sum(axis=1) != 1))
+    if len(invalid):
+        raise ValueError('Label %d is %s, which is not one-hot encoded'
+                         % (invalid[0], labels[invalid[0]].tolist()))
+    return np.argmax(labels, axis=1)
+
+
+# (predicted, true) class indices of a MISCLASSIFIED list of
+# (image, predicted_label, true_label) tuples, or of a (predicted, true) pair
+def misclassified_indices(misclassified):
+    if isinstance(misclassified, tuple) and len(misclassified) == 2:
+        predicted, true = misclassified
+    else:
+        predicted = [item[1] for item in misclassified]
+        true = [item[2] for item in misclassified]
+    return as_class_indices(predicted), as_class_indices(true)
+
+
+class ArrayTests(unittest.TestCase):
+
+    # Tests that one_hot_function returns the expected label for each class
+    # (a list or an array)
+    def test_one_hot(self, one_hot_function):
+        try:
+            expected = np.eye(NUM_CLASSES, dtype=int)
+            actual = np.array([np.asarray(one_hot_function(label))
+                               for label in ['red', 'yellow', 'green']])
+            self.assertEqual(expected.shape, actual.shape)
+            self.assertTrue((expected == actual).all(),
+                            'Expected %s, got %s' % (expected.tolist(), actual.tolist()))
+        except self.failureException as e:
+            print_fail()
+            print('Your function did not return the expected one-hot label.')
+            print('\n' + str(e))
+            return
+        print_pass()
+
+    # Tests that every label is a valid class index or one-hot label
+    def test_labels(self, labels, num_classes=NUM_CLASSES):
+        try:
+            as_class_indices(labels, num_classes)
+        except ValueError as e:
+            print_fail()
+            print('The labels are not valid.')
+            print('\n' + str(e))
+            return
+        print_pass()
+
+    # Tests that no red light was classified as green
+    def test_red_as_green(self, misclassified):
+        try:
+            predicted, true = misclassified_indices(misclassified)
+            red_as_green = np.flatnonzero((true == RED) & (predicted == GREEN))
+            self.assertEqual(0, len(red_as_green),
+                             '%d red lights were classified as green (first at index %s)'
+                             % (len(red_as_green), red_as_green[:1].tolist()))
+        except ValueError as e:
+            print_fail()
+            print('The misclassified labels are not valid.')
+            print('\n' + str(e))
+            return
+        except self.failureException as e:
+            print_fail()
+            print('Warning: A red light is classified as green.')
+            print('\n' + str(e))
+            return
+        print_pass()
@@ -0,0 +1,125 @@
+# Streaming, vectorized augmentation of standardized image batches
+#
+# Tuning the thresholds and checking robustness needs brightness, contrast,
+# hue-shift, blur and small-translation variants of STANDARDIZED_LIST.
+# Augmenter applies random transforms to a whole (N, 32, 32, 3) batch with
+# NumPy operations (no per-image cv2 calls), and augment_batches() produces
+# the augmented data chunk by chunk so it is never stored in full. Everything
+# is driven by a seed, so the same seed gives the same variants.
+#
+# Example:
+#   images, labels = batch_features.to_arrays(STANDARDIZED_TEST_LIST)
+#   print(augment.evaluate(images, labels, estimate_label, num_variants=10, seed=0))
+
+import numpy as np
+
+import batch_features
+
+# Batch size of the augmented chunks
+CHUNK_SIZE = 1024
+
+# Hue rotation of RGB colours by an angle a around the grey axis, keeping the
+# luminance: M = LUMA + cos(a) * COS + sin(a) * SIN (as in the CSS/SVG
+# hue-rotate filter)
+_HUE_LUMA = np.array([[0.213, 0.715, 0.072]] * 3, dtype=np.float32)
+_HUE_COS = np.array([[0.787, -0.715, -0.072],
+                     [-0.213, 0.285, -0.072],
+                     [-0.213, -0.715, 0.928]], dtype=np.float32)
+_HUE_SIN = np.array([[-0.213, -0.715, 0.928],
+                     [0.143, 0.140, -0.283],
+                     [-0.787, 0.715, 0.072]], dtype=np.float32)
+
+
+# Per-image (N, 3, 3) hue rotation matrices for `angles` in radians
+def _hue_matrices(angles):
+    cos = np.cos(angles).astype(np.float32)[:, None, None]
+    sin = np.sin(angles).astype(np.float32)[:, None, None]
+    return _HUE_LUMA + cos * _HUE_COS + sin * _HUE_SIN
+
+
+# 3x3 box blur of an (N, H, W, C) float batch with edge pixels repeated
+def _box_blur(images):
+    padded = np.pad(images, ((0, 0), (1, 1), (1, 1), (0, 0)), mode='edge')
+    rows = padded[:, :-2] + padded[:, 1:-1] + padded[:, 2:]
+    return (rows[:, :, :-2] + rows[:, :, 1:-1] + rows[:, :, 2:]) / 9.0
+
+
+class Augmenter(object):
+
+    # brightness: largest offset added to every channel
+    # contrast: (low, high) range of the contrast factor
+    # hue: largest hue rotation in degrees
+    # blur: probability that an image is blurred (3x3 box blur)
+    # translate: largest shift in pixels along each axis (edges repeated)
+    def __init__(self, brightness=30, contrast=(0.7, 1.3), hue=15, blur=0.3, translate=2, seed=None):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.hue = hue
+        self.blur = blur
+        self.translate = translate
+        self.rng = np.random.default_rng(seed)
+
+    # Augment an (N, H, W, 3) uint8 batch; returns a new uint8 batch
+    def augment(self, images):
+        n, h, w = images.shape[:3]
+        rng = self.rng
+        out = images.astype(np.float32)
+
+        if self.translate:
+            dy = rng.integers(-self.translate, self.translate + 1, n)
+            dx = rng.integers(-self.translate, self.translate + 1, n)
+            rows = np.clip(np.arange(h)[None, :] - dy[:, None], 0, h - 1)
+            cols = np.clip(np.arange(w)[None, :] - dx[:, None], 0, w - 1)
+            out = out[np.arange(n)[:, None, None], rows[:, :, None], cols[:, None, :]]
+
+        if self.hue:
+            angles = np.radians(rng.uniform(-self.hue, self.hue, n))
+            out = np.matmul(out.reshape(n, h * w, 3),
+                            _hue_matrices(angles).transpose(0, 2, 1)).reshape(n, h, w, 3)
+
+        if self.contrast is not None:
+            factor = rng.uniform(self.contrast[0], self.contrast[1], n).astype(np.float32)[:, None, None, None]
+            mean = out.mean(axis=(1, 2, 3), keepdims=True)
+            out -= mean
+            out *= factor
+            out += mean
+
+        if self.brightness:
+            out += rng.uniform(-self.brightness, self.brightness, n).astype(np.float32)[:, None, None, None]
+
+        if self.blur:
+            blurred = rng.random(n) < self.blur
+            if blurred.any():
+                out[blurred] = _box_blur(out[blurred])
+
+        return np.clip(out, 0, 255, out=out).astype(np.uint8)
+
+
+# Yield (augmented_images, labels) chunks of num_variants augmented copies of
+# an (N, H, W, 3) batch and its labels, never holding more than one chunk
+def augment_batches(images, labels, num_variants=1, chunk_size=CHUNK_SIZE, seed=None, **kwargs):
+    augmenter = Augmenter(seed=seed, **kwargs)
+    labels = np.asarray(labels)
+    for _ in range(num_variants):
+        for start in range(0, len(images), chunk_size):
+            yield augmenter.augment(images[start:start + chunk_size]), labels[start:start + chunk_size]
+
+
+# Accuracy and red-as-green errors on the augmented variants. estimate_label
+# is the notebook function (called per image, one-hot result); without it the
+# batched brightness classifier of batch_features is used.
+def evaluate(images, labels, estimate_label=None, num_variants=1, chunk_size=CHUNK_SIZE,
+             seed=None, **kwargs):
+    correct = 0
+    total = 0
+    red_as_green = 0
+    for batch, batch_labels in augment_batches(images, labels, num_variants, chunk_size, seed, **kwargs):
+        if estimate_label is None:
+            predicted = batch_features.estimate_label_batch(batch_features.brightness_features(batch))
+        else:
+            predicted = np.array([batch_features.one_hot_to_index(estimate_label(image))
+                                  for image in batch])
+        correct += int(np.sum(predicted == batch_labels))
+        red_as_green += int(np.sum((batch_labels == 0) & (predicted == 2)))
+        total += len(batch_labels)
+    return {'images': total, 'accuracy': correct / float(max(total, 1)), 'red_as_green': red_as_green}
@@ -0,0 +1,341 @@
+# Batched feature extraction and classification for standardized traffic light images
+#
+# The notebook computes the three-band brightness feature one image at a time.
+# The functions here work on a whole (N, 32, 32, 3) uint8 batch at once and
+# add a richer per-band hue/saturation histogram feature that is scored by a
+# nearest-centroid classifier using a single matrix multiply.
+
+import cv2
+import numpy as np
+
+# Class order used by the one-hot labels: [red value, yellow value, green value]
+CLASSES = ['red', 'yellow', 'green']
+
+# Same parameters as the brightness feature in the notebook
+LOW_THRSH = np.array([0, 0, 19])
+HIGH_THRSH = np.array([255, 59, 198])
+CROP_X = 8
+CROP_Y = 3
+# Rows of each light inside the cropped image (red, yellow, green)
+BAND_ROWS = ((2, 11), (11, 19), (19, 27))
+
+# Default standard image size, and the crop / band geometry above expressed as
+# fractions of it so it can be scaled to other standard sizes
+STANDARD_SIZE = 32
+CROP_X_FRACTION = CROP_X / 32.0
+CROP_Y_FRACTION = CROP_Y / 32.0
+BAND_ROW_FRACTIONS = tuple((start / 32.0, end / 32.0) for start, end in BAND_ROWS)
+# Threshold used by estimate_label when red, yellow and green values are similar
+THRSH = 10
+
+# Number of images converted by a single cv2 call (keeps the stacked image
+# well inside OpenCV's size limits)
+CHUNK_SIZE = 4096
+
+
+# Convert a one-hot label such as [0, 1, 0] into its class index (1)
+def one_hot_to_index(one_hot_label):
+    return int(np.argmax(one_hot_label))
+
+
+# Convert a class index into a one-hot encoded list label
+def index_to_one_hot(index):
+    one_hot_encoded = [0, 0, 0]
+    one_hot_encoded[int(index)] = 1
+    return one_hot_encoded
+
+
+# Turn a STANDARDIZED_LIST of (image, one_hot_label) pairs into two arrays:
+# an (N, H, W, 3) uint8 image batch and an (N,) array of class indices
+def to_arrays(standard_list):
+    images = np.stack([item[0] for item in standard_list]).astype(np.uint8, copy=False)
+    labels = np.array([one_hot_to_index(item[1]) for item in standard_list], dtype=np.int64)
+    return images, labels
+
+
+# Apply a per-pixel cv2 function to a batch by stacking the images vertically,
+# so every chunk of images is handled by one OpenCV call
+def _stacked(images, function):
+    n, h, w = images.shape[:3]
+    results = []
+    for start in range(0, n, CHUNK_SIZE):
+        chunk = np.ascontiguousarray(images[start:start + CHUNK_SIZE])
+        stacked = chunk.reshape(-1, w, chunk.shape[3])
+        out = function(stacked)
+        results.append(out.reshape((chunk.shape[0], h, w) + out.shape[2:]))
+    if len(results) == 1:
+        return results[0]
+    return np.concatenate(results)
+
+
+# Convert a batch of RGB images into HSV
+def hsv_batch(images):
+    return _stacked(images, lambda im: cv2.cvtColor(im, cv2.COLOR_RGB2HSV))
+
+
+# Boolean (N, H, W) array of the pixels kept by the brightness feature,
+# i.e. the pixels that are *outside* the low/high HSV thresholds
+def keep_mask_batch(hsv_images, low_thrsh=LOW_THRSH, high_thrsh=HIGH_THRSH):
+    mask = _stacked(hsv_images, lambda im: cv2.inRange(im, low_thrsh, high_thrsh))
+    return mask == 0
+
+
+# Scale crop / band geometry defined for a base x base standard image to an
+# image of the given height and width
+def scale_geometry(crop_x, crop_y, band_rows, height, width, base=STANDARD_SIZE):
+    scale = lambda value, size: int(np.floor(value / float(base) * size + 0.5))
+    band_rows = tuple((scale(start, height), scale(end, height)) for start, end in band_rows)
+    return scale(crop_x, width), scale(crop_y, height), band_rows
+
+
+_geometry_cache = {}
+
+
+# (crop_x, crop_y, band_rows) for a standard image of the given size, scaled
+# from the 32x32 geometry. Computed once per size.
+def band_geometry(height, width=None):
+    if width is None:
+        width = height
+    if (height, width) not in _geometry_cache:
+        _geometry_cache[height, width] = scale_geometry(CROP_X, CROP_Y, BAND_ROWS, height, width, 32)
+    return _geometry_cache[height, width]
+
+
+# Absolute (row_start, row_end) of each band and the (col_start, col_end) of
+# the crop, for a standard image of the given height and width. Geometry that
+# is not given is scaled to the image size with band_geometry.
+def band_slices(height, width, crop_x=None, crop_y=None, band_rows=None):
+    default_crop_x, default_crop_y, default_band_rows = band_geometry(height, width)
+    crop_x = default_crop_x if crop_x is None else crop_x
+    crop_y = default_crop_y if crop_y is None else crop_y
+    band_rows = default_band_rows if band_rows is None else band_rows
+    cropped_height = height - 2 * crop_y
+    rows = []
+    for start, end in band_rows:
+        # Same clipping as slicing the cropped image in create_feature
+        start = min(start, cropped_height)
+        end = min(end, cropped_height)
+        rows.append((crop_y + start, crop_y + end))
+    return rows, (crop_x, width - crop_x)
+
+
+# (N, bands) uint32 sums of R + G + B over the kept pixels of every band.
+# keep is the (N, H, W) boolean mask of the kept pixels, rows the
+# (row_start, row_end) of each band and cols the (col_start, col_end) of the
+# crop, as returned by band_slices.
+def masked_band_sums(images, keep, rows, cols):
+    # Explicit adds are much faster than a sum over the short channel axis
+    pixel_sum = images[..., 0].astype(np.uint16)
+    pixel_sum += images[..., 1]
+    pixel_sum += images[..., 2]
+    pixel_sum *= keep
+
+    col_start, col_end = cols
+    sums = np.empty((len(images), len(rows)), dtype=np.uint32)
+    for b, (row_start, row_end) in enumerate(rows):
+        sums[:, b] = pixel_sum[:, row_start:row_end, col_start:col_end].sum(axis=(1, 2), dtype=np.uint32)
+    return sums
+
+
+# (N, bands) uint32 band sums of the kept pixels of an (N, H, W, 3) uint8
+# batch, the rows of every band and the width of the crop
+def band_sums_batch(images, low_thrsh=LOW_THRSH, high_thrsh=HIGH_THRSH,
+                    crop_x=None, crop_y=None, band_rows=None):
+    h, w = images.shape[1:3]
+    keep = keep_mask_batch(hsv_batch(images), low_thrsh, high_thrsh)
+    rows, cols = band_slices(h, w, crop_x, crop_y, band_rows)
+    sums = masked_band_sums(images, keep, rows, cols)
+    return sums, [row_end - row_start for row_start, row_end in rows], cols[1] - cols[0]
+
+
+# Vectorized version of create_feature: returns an (N, 3) float array with the
+# average brightness of the red, yellow and green sections of every image
+def brightness_features(images, low_thrsh=LOW_THRSH, high_thrsh=HIGH_THRSH,
+                        crop_x=None, crop_y=None, band_rows=None):
+    sums, rows, width = band_sums_batch(images, low_thrsh, high_thrsh, crop_x, crop_y, band_rows)
+    return sums / (np.array(rows, dtype=np.float64) * width)
+
+
+# Vectorized version of the estimate_label rules: takes (N, 3) brightness
+# features and returns the (N,) predicted class indices
+def estimate_label_batch(features, thrsh=THRSH):
+    red = features[:, 0]
+    yellow = features[:, 1]
+    green = features[:, 2]
+
+    is_red = (red > yellow) & (red > green)
+    # Special case where the image is classified based on the average of yellow and green
+    is_red |= (red > yellow) & (red < green) & (red + thrsh > ((yellow + green) / 2))
+    is_yellow = (red < yellow) & (yellow > green)
+    is_green = (red < green) & (yellow < green)
+
+    # Anything that matches none of the rules is yellow, as in estimate_label
+    return np.select([is_red, is_yellow, is_green], [0, 1, 2], default=1)
+
+
+_histogram_cache = {}
+
+
+# Layout of the histogram features for one image size: the pixel positions
+# inside the bands, the first bin of the band of each of them, the band areas
+# and the hue / saturation bin of every 8-bit value. For single images also
+# the (top, bottom, col_start, col_end) region around the bands with the first
+# bin of every region pixel, and the mask of the region pixels inside a band
+# (None when they all are). Computed once per size and geometry.
+def _histogram_layout(h, w, hue_bins, sat_bins, crop_x, crop_y, band_rows):
+    key = (h, w, hue_bins, sat_bins, crop_x, crop_y,
+           None if band_rows is None else tuple(tuple(rows) for rows in band_rows))
+    if key not in _histogram_cache:
+        rows, (col_start, col_end) = band_slices(h, w, crop_x, crop_y, band_rows)
+        bins = hue_bins + sat_bins
+
+        # Band index of each pixel position, -1 outside the bands
+        band_map = np.full((h, w), -1, dtype=np.int64)
+        areas = np.empty(len(rows), dtype=np.float32)
+        for b, (row_start, row_end) in enumerate(rows):
+            band_map[row_start:row_end, col_start:col_end] = b
+            areas[b] = (row_end - row_start) * (col_end - col_start)
+        inside = band_map >= 0
+        band_base = (band_map[inside] * bins).astype(np.int32)
+        region = (min(start for start, _ in rows), max(end for _, end in rows), col_start, col_end)
+        region_map = band_map[region[0]:region[1], region[2]:region[3]]
+        region_base = (region_map * bins).astype(np.int32)
+        region_inside = None if (region_map >= 0).all() else region_map >= 0
+
+        # Histogram bin of every hue / saturation value (OpenCV hue is in
+        # [0, 180) for 8-bit images, saturation in [0, 256))
+        values = np.arange(256)
+        hue_lut = np.minimum(values * hue_bins // 180, hue_bins - 1).astype(np.int32)
+        sat_lut = (hue_bins + values * sat_bins // 256).astype(np.int32)
+        _histogram_cache[key] = (inside, band_base, areas, hue_lut, sat_lut,
+                                 region, region_base, region_inside)
+    return _histogram_cache[key]
+
+
+# Per-band hue and saturation histograms for a batch of RGB images.
+# Only the pixels kept by the brightness mask are counted, and each histogram
+# is normalized by the band area. All bins for all images are counted with a
+# single np.bincount over flattened (image, band, bin) offsets.
+# Returns an (N, bands * (hue_bins + sat_bins)) float32 array.
+def histogram_features(images, hue_bins=12, sat_bins=8,
+                       low_thrsh=LOW_THRSH, high_thrsh=HIGH_THRSH,
+                       crop_x=None, crop_y=None, band_rows=None):
+    n, h, w = images.shape[:3]
+    hsv = hsv_batch(images)
+    keep = keep_mask_batch(hsv, low_thrsh, high_thrsh)
+    inside, band_base, areas, hue_lut, sat_lut = _histogram_layout(
+        h, w, hue_bins, sat_bins, crop_x, crop_y, band_rows)[:5]
+    num_bands = len(areas)
+    stride = num_bands * (hue_bins + sat_bins)
+
+    # Only look at the kept pixels inside the bands
+    kept = keep[:, inside]
+    image_base = np.arange(n, dtype=np.int64)[:, None] * stride
+    hue_offsets = (image_base + (band_base + hue_lut[hsv[:, inside, 0]]))[kept]
+    sat_offsets = (image_base + (band_base + sat_lut[hsv[:, inside, 1]]))[kept]
+
+    counts = np.bincount(np.concatenate([hue_offsets, sat_offsets]), minlength=n * stride)
+
+    features = counts.reshape(n, num_bands, hue_bins + sat_bins).astype(np.float32)
+    features /= areas[None, :, None]
+    return features.reshape(n, stride)
+
+
+# histogram_features of a single RGB image, without the batch machinery: the
+# HSV conversion and the mask only cover the region around the bands (one cv2
+# call each). Returns a flat float32 array.
+def histogram_feature(rgb_image, hue_bins=12, sat_bins=8,
+                      low_thrsh=LOW_THRSH, high_thrsh=HIGH_THRSH,
+                      crop_x=None, crop_y=None, band_rows=None):
+    h, w = rgb_image.shape[:2]
+    _, _, areas, hue_lut, sat_lut, region, region_base, region_inside = _histogram_layout(
+        h, w, hue_bins, sat_bins, crop_x, crop_y, band_rows)
+    top, bottom, col_start, col_end = region
+    hsv = cv2.cvtColor(rgb_image[top:bottom, col_start:col_end], cv2.COLOR_RGB2HSV)
+    kept = cv2.inRange(hsv, low_thrsh, high_thrsh) == 0
+    if region_inside is not None:
+        kept &= region_inside
+
+    stride = len(areas) * (hue_bins + sat_bins)
+    counts = np.bincount((region_base + hue_lut[hsv[..., 0]])[kept], minlength=stride)
+    counts += np.bincount((region_base + sat_lut[hsv[..., 1]])[kept], minlength=stride)
+    features = counts.reshape(len(areas), -1).astype(np.float32)
+    features /= areas[:, None]
+    return features.reshape(-1)
+
+
+# Nearest-centroid classifier. Distances to the class centroids are turned
+# into a linear score, so predicting a whole batch is one matrix multiply:
+#   argmin |x - c|^2  ==  argmax (x . c - |c|^2 / 2)
+# Feature scaling (mean / std) is folded into the weights as well.
+class NearestCentroid(object):
+
+    def __init__(self, num_classes=len(CLASSES)):
+        self.num_classes = num_classes
+        self.weights = None
+        self.bias = None
+
+    def fit(self, features, labels):
+        features = np.asarray(features, dtype=np.float64)
+        labels = np.asarray(labels)
+        mean = features.mean(axis=0)
+        std = features.std(axis=0)
+        std[std == 0] = 1.0
+        scaled = (features - mean) / std
+
+        centroids = np.zeros((self.num_classes, features.shape[1]))
+        for c in range(self.num_classes):
+            members = scaled[labels == c]
+            if len(members) == 0:
+                # A class never seen in training can never be predicted
+                centroids[c] = np.inf
+            else:
+                centroids[c] = members.mean(axis=0)
+
+        finite = np.isfinite(centroids).all(axis=1)
+        weights = np.where(finite[:, None], centroids, 0.0) / std
+        bias = -0.5 * (np.where(finite[:, None], centroids, 0.0) ** 2).sum(axis=1)
+        bias -= weights.dot(mean)
+        bias[~finite] = -np.inf
+
+        self.weights = weights.T.astype(np.float32)
+        self.bias = bias.astype(np.float32)
+        return self
+
+    # (N, num_classes) scores, larger is better
+    def scores(self, features):
+        return np.asarray(features, dtype=np.float32).dot(self.weights) + self.bias
+
+    def predict(self, features):
+        return np.argmax(self.scores(features), axis=1)
+
+
+# Histogram features + nearest-centroid classifier, usable as an alternative
+# backend to estimate_label. Train it with a STANDARDIZED_LIST, then either
+# classify whole batches with predict_batch, or pass classifier.estimate_label
+# wherever the notebook's estimate_label is used.
+class HistogramClassifier(object):
+
+    def __init__(self, hue_bins=12, sat_bins=8):
+        self.hue_bins = hue_bins
+        self.sat_bins = sat_bins
+        self.model = NearestCentroid()
+
+    def features(self, images):
+        return histogram_features(images, self.hue_bins, self.sat_bins)
+
+    def fit(self, standard_list):
+        images, labels = to_arrays(standard_list)
+        self.model.fit(self.features(images), labels)
+        return self
+
+    # Class indices for an (N, H, W, 3) batch of standardized images
+    def predict_batch(self, images):
+        return self.model.predict(self.features(images))
+
+    # Same interface as estimate_label: RGB image in, one-hot label out.
+    # Uses the single-image feature path, which is at least as fast per image
+    # as the notebook's estimate_label; predict_batch is faster still.
+    def estimate_label(self, rgb_image):
+        features = histogram_feature(np.asarray(rgb_image), self.hue_bins, self.sat_bins)
+        return index_to_one_hot(self.model.predict(features[None])[0])
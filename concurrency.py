@@ -0,0 +1,174 @@
+# Thread-pool execution of standardize / create_feature with one concurrency setting
+#
+# cv2.resize, cv2.cvtColor and cv2.inRange release the GIL, so a pool of
+# Python threads can run the per-image functions on several cores. OpenCV
+# and the BLAS library behind NumPy also start their own threads, and using
+# all of them at once oversubscribes the machine. A Concurrency setting
+# splits one core budget between:
+#   - the number of Python worker threads
+#   - cv2.setNumThreads (OpenCV's internal threads, shared by all workers)
+#   - NumPy/BLAS threads (threadpoolctl when installed, and the OMP/BLAS
+#     environment variables for libraries loaded later)
+# benchmark() tries every split of every core count and reports the best.
+#
+# Example:
+#   setting = concurrency.Concurrency(cores=4)
+#   STANDARDIZED_LIST = concurrency.standardize_parallel(
+#       IMAGE_LIST, standardize_input, one_hot_encode, setting)
+#   features = concurrency.create_features_parallel(images, create_feature, setting)
+
+import contextlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+# Environment variables read by OpenMP and the BLAS libraries when they load
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+# Work items handed to every worker thread (keeps per-task overhead small
+# while still balancing the load)
+CHUNKS_PER_WORKER = 4
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# A core budget and how it is split. By default every core runs one Python
+# worker and the native libraries stay single-threaded, which avoids
+# oversubscription; with fewer workers the remaining cores go to OpenCV.
+class Concurrency(object):
+
+    def __init__(self, cores=None, workers=None, cv2_threads=None, blas_threads=1):
+        self.cores = cores or available_cores()
+        self.workers = workers or self.cores
+        if cv2_threads is None:
+            cv2_threads = max(1, self.cores // self.workers) if self.workers < self.cores else 1
+        self.cv2_threads = cv2_threads
+        self.blas_threads = blas_threads
+
+    def __repr__(self):
+        return 'Concurrency(cores=%d, workers=%d, cv2_threads=%d, blas_threads=%d)' % (
+            self.cores, self.workers, self.cv2_threads, self.blas_threads)
+
+    # Apply the thread limits inside a `with` block and restore them afterwards
+    @contextlib.contextmanager
+    def apply(self):
+        previous_cv2 = cv2.getNumThreads()
+        previous_env = dict((name, os.environ.get(name)) for name in THREAD_ENV_VARS)
+        # OpenCV counts the calling thread too: 1 means no extra threads,
+        # while 0 would disable its thread pool entirely
+        cv2.setNumThreads(self.cv2_threads)
+        for name in THREAD_ENV_VARS:
+            os.environ[name] = str(self.blas_threads)
+        limits = None
+        if threadpoolctl is not None:
+            limits = threadpoolctl.threadpool_limits(limits=self.blas_threads)
+        try:
+            yield self
+        finally:
+            if limits is not None:
+                limits.restore_original_limits()
+            for name, value in previous_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            cv2.setNumThreads(previous_cv2)
+
+
+# Apply function to every item with the workers of a Concurrency setting,
+# keeping the order. Items are handed out in chunks.
+def map_parallel(function, items, setting=None):
+    if setting is None:
+        setting = Concurrency()
+    items = list(items)
+    with setting.apply():
+        if setting.workers == 1 or len(items) < 2:
+            return [function(item) for item in items]
+        num_chunks = min(len(items), setting.workers * CHUNKS_PER_WORKER)
+        bounds = [len(items) * i // num_chunks for i in range(num_chunks + 1)]
+        with ThreadPoolExecutor(setting.workers) as executor:
+            chunks = executor.map(lambda start, end: [function(item) for item in items[start:end]],
+                                  bounds[:-1], bounds[1:])
+            return [result for chunk in chunks for result in chunk]
+
+
+# Same result as the notebook's standardize(image_list), computed in parallel
+def standardize_parallel(image_list, standardize_input, one_hot_encode, setting=None):
+    return map_parallel(lambda item: (standardize_input(item[0]), one_hot_encode(item[1])),
+                        image_list, setting)
+
+
+# create_feature of every standardized image, computed in parallel
+def create_features_parallel(images, create_feature, setting=None):
+    return map_parallel(create_feature, images, setting)
+
+
+# Pin the process to `cores` CPUs inside a `with` block (Linux only)
+@contextlib.contextmanager
+def _restricted_to(cores):
+    if not hasattr(os, 'sched_setaffinity'):
+        yield
+        return
+    allowed = sorted(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, allowed[:cores])
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, allowed)
+
+
+# Settings worth trying for a core budget: every number of workers that
+# divides it, with the leftover cores given to OpenCV
+def candidate_settings(cores):
+    return [Concurrency(cores, workers) for workers in range(1, cores + 1) if cores % workers == 0]
+
+
+# Time standardize + create_feature of image_list (best of `repeats` runs) for
+# every candidate setting of every core count, with the process pinned to
+# that many cores. Returns one result per core count with all timings and the
+# best setting.
+def benchmark(image_list, standardize_input, one_hot_encode, create_feature,
+              core_counts=None, repeats=3):
+    if core_counts is None:
+        core_counts = sorted(set([1, 2, 4, 8, 16, available_cores()]))
+        core_counts = [cores for cores in core_counts if cores <= available_cores()]
+    results = []
+    for cores in core_counts:
+        timings = []
+        with _restricted_to(cores):
+            for setting in candidate_settings(cores):
+                best = float('inf')
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    standard_list = standardize_parallel(image_list, standardize_input,
+                                                         one_hot_encode, setting)
+                    create_features_parallel([item[0] for item in standard_list],
+                                             create_feature, setting)
+                    best = min(best, time.perf_counter() - start)
+                timings.append({'workers': setting.workers,
+                                'cv2_threads': setting.cv2_threads,
+                                'images_per_second': len(image_list) / best})
+        best_timing = max(timings, key=lambda timing: timing['images_per_second'])
+        results.append({'cores': cores, 'timings': timings, 'best': best_timing})
+    return results
+
+
+def format_benchmark(results):
+    lines = ['%6s %8s %12s %12s' % ('cores', 'workers', 'cv2 threads', 'images/s')]
+    for result in results:
+        for timing in result['timings']:
+            lines.append('%6d %8d %12d %12.0f%s' % (
+                result['cores'], timing['workers'], timing['cv2_threads'],
+                timing['images_per_second'], '  best' if timing is result['best'] else ''))
+    return '\n'.join(lines)
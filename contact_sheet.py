@@ -0,0 +1,159 @@
+# Contact sheets of misclassified images, rendered off the inference thread
+#
+# Looking at MISCLASSIFIED one plt.imshow() at a time does not scale to
+# thousands of errors. render_page() tiles a batch of standardized images into
+# one large array with a single reshape/transpose, and writes the predicted and
+# true labels (and optionally the create_feature brightness values) under
+# every tile with cv2.putText. ContactSheetWriter collects images into pages
+# and renders and saves the PNG pages on a background thread, so the
+# classification loop only appends to a list. Matplotlib is not needed.
+#
+# Example:
+#   with contact_sheet.ContactSheetWriter('misclassified', create_feature) as writer:
+#       writer.add_many(MISCLASSIFIED)
+#   print(writer.pages)
+
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from batch_features import CLASSES, one_hot_to_index
+
+# Text colours (RGB) of the class names
+CLASS_COLOURS = [(255, 80, 80), (255, 220, 60), (80, 255, 120)]
+CAPTION_HEIGHT = 26
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.3
+
+
+def _class_index(label):
+    if isinstance(label, str):
+        return CLASSES.index(label)
+    if isinstance(label, (int, np.integer)):
+        return int(label)
+    return one_hot_to_index(label)
+
+
+# Arrange an (N, h, w, 3) batch into a grid with `columns` tiles per row;
+# missing tiles of the last row are filled with pad_value
+def tile(images, columns, pad_value=0):
+    n, h, w, c = images.shape
+    rows = -(-n // columns)
+    if rows * columns != n:
+        padding = np.full((rows * columns - n, h, w, c), pad_value, dtype=images.dtype)
+        images = np.concatenate([images, padding])
+    return images.reshape(rows, columns, h, w, c).transpose(0, 2, 1, 3, 4).reshape(rows * h, columns * w, c)
+
+
+# One RGB contact sheet of (image, predicted_label, true_label) items, with
+# labels given as one-hot lists, class indices or names. Every image is
+# enlarged `scale` times and captioned with "predicted / true" and, if
+# create_feature is given, its [red, yellow, green] brightness values.
+def render_page(items, create_feature=None, columns=16, scale=3):
+    images = np.stack([item[0] for item in items]).astype(np.uint8, copy=False)
+    n, h, w = images.shape[:3]
+    cell_h = h * scale + CAPTION_HEIGHT
+    cell_w = w * scale
+    cells = np.zeros((n, cell_h, cell_w, 3), dtype=np.uint8)
+    cells[:, :h * scale] = images.repeat(scale, axis=1).repeat(scale, axis=2)
+    sheet = tile(cells, columns)
+
+    for i, (image, predicted, true) in enumerate(items):
+        x = (i % columns) * cell_w + 2
+        y = (i // columns) * cell_h + h * scale
+        predicted = _class_index(predicted)
+        true = _class_index(true)
+        cv2.putText(sheet, CLASSES[predicted], (x, y + 10), FONT, FONT_SCALE,
+                    CLASS_COLOURS[predicted], 1, cv2.LINE_AA)
+        cv2.putText(sheet, '/' + CLASSES[true], (x + cell_w // 2, y + 10), FONT, FONT_SCALE,
+                    CLASS_COLOURS[true], 1, cv2.LINE_AA)
+        if create_feature is not None:
+            values = ' '.join('%.0f' % value for value in create_feature(image))
+            cv2.putText(sheet, values, (x, y + 22), FONT, FONT_SCALE, (200, 200, 200), 1, cv2.LINE_AA)
+    return sheet
+
+
+# Collects misclassified images into pages of rows x columns tiles and renders
+# and writes every full page as <output_dir>/<prefix>-0000.png on a writer
+# thread. Pages only hold references to the images, so queueing them is cheap
+# and add() never waits for rendering.
+class ContactSheetWriter(object):
+
+    def __init__(self, output_dir, create_feature=None, columns=16, rows=16, scale=3,
+                 prefix='misclassified'):
+        self.output_dir = output_dir
+        self.create_feature = create_feature
+        self.columns = columns
+        self.page_size = rows * columns
+        self.scale = scale
+        self.prefix = prefix
+        self.pages = []
+        self._items = []
+        self._page_count = 0
+        self._pages = queue.Queue()
+        self._error = None
+        os.makedirs(output_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, image, predicted_label, true_label):
+        self._items.append((image, predicted_label, true_label))
+        if len(self._items) >= self.page_size:
+            self.flush()
+
+    # Add a MISCLASSIFIED list of (image, predicted_label, true_label) tuples
+    def add_many(self, misclassified):
+        for item in misclassified:
+            self.add(*item[:3])
+
+    # Hand the collected images to the writer thread as a (partial) page
+    def flush(self):
+        if self._error is not None:
+            raise self._error
+        if not self._items:
+            return
+        items, self._items = self._items, []
+        path = os.path.join(self.output_dir, '%s-%04d.png' % (self.prefix, self._page_count))
+        self._page_count += 1
+        self._pages.put((path, items))
+
+    def _run(self):
+        while True:
+            page = self._pages.get()
+            if page is None:
+                break
+            path, items = page
+            try:
+                sheet = render_page(items, self.create_feature, self.columns, self.scale)
+                if not cv2.imwrite(path, cv2.cvtColor(sheet, cv2.COLOR_RGB2BGR)):
+                    raise IOError('Could not write ' + path)
+                self.pages.append(path)
+            except Exception as e:
+                self._error = e
+
+    # Write the last partial page and wait for the writer thread
+    def close(self):
+        if not self._thread.is_alive():
+            return
+        self.flush()
+        self._pages.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+# Write contact sheets of a whole MISCLASSIFIED list and return the page paths
+def write_contact_sheets(misclassified, output_dir, create_feature=None, **kwargs):
+    with ContactSheetWriter(output_dir, create_feature, **kwargs) as writer:
+        writer.add_many(misclassified)
+    return writer.pages
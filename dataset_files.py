@@ -0,0 +1,31 @@
+# Listing and reading the image files of a traffic light dataset
+#
+# Datasets are laid out like helpers.load_dataset expects:
+#   image_dir/red/*.jpg, image_dir/yellow/*.jpg, image_dir/green/*.jpg
+# These functions work with file paths instead of loading every image, so
+# other tools can read only the files they need.
+
+import glob
+import os
+
+import cv2
+
+# Label directories, in the same order as the one-hot labels
+IMAGE_TYPES = ['red', 'yellow', 'green']
+
+
+# List the (path, label) pairs of every image in a dataset directory
+def list_dataset_files(image_dir):
+    files = []
+    for im_type in IMAGE_TYPES:
+        for path in sorted(glob.glob(os.path.join(image_dir, im_type, '*'))):
+            files.append((path, im_type))
+    return files
+
+
+# Read an image file as an RGB uint8 array
+def read_image(path):
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise IOError('Could not read image: ' + path)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
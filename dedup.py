@@ -0,0 +1,169 @@
+# Perceptual-hash index for standardized traffic light images
+#
+# Crops taken from video are often near-identical from one frame to the next.
+# The functions here compute 64-bit aHash / dHash values for a whole batch of
+# standardized images at once, and HashIndex finds earlier images within a
+# small Hamming distance using bucketed lookups. This is used to remove near
+# duplicates from a dataset and to reuse the label of a crop that has already
+# been classified.
+
+import numpy as np
+
+# Number of set bits for every byte value, used to count differing hash bits
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+# Grayscale version of an (N, H, W, 3) RGB batch, as float32
+def grayscale_batch(images):
+    images = np.asarray(images)
+    gray = images[..., 0] * np.float32(0.299)
+    gray += images[..., 1] * np.float32(0.587)
+    gray += images[..., 2] * np.float32(0.114)
+    return gray
+
+
+# Average a (N, H, W) batch over a grid of rows x cols blocks. Block edges are
+# spread evenly, so the grid does not need to divide the image size.
+def _block_means(gray, rows, cols):
+    h, w = gray.shape[1:]
+    row_edges = np.linspace(0, h, rows + 1).astype(int)
+    col_edges = np.linspace(0, w, cols + 1).astype(int)
+    sums = np.add.reduceat(gray, row_edges[:-1], axis=1)
+    sums = np.add.reduceat(sums, col_edges[:-1], axis=2)
+    counts = np.outer(np.diff(row_edges), np.diff(col_edges))
+    return sums / counts
+
+
+# Pack an (N, 64) boolean array into (N,) uint64 hashes
+def _pack_bits(bits):
+    packed = np.packbits(bits.astype(np.uint8), axis=1)
+    return packed.view('>u8').ravel().astype(np.uint64)
+
+
+# Average hash: 8x8 block means compared against the image mean
+def ahash_batch(images):
+    means = _block_means(grayscale_batch(images), 8, 8).reshape(len(images), 64)
+    return _pack_bits(means > means.mean(axis=1, keepdims=True))
+
+
+# Difference hash: 8x9 block means, each compared with its right neighbour
+def dhash_batch(images):
+    means = _block_means(grayscale_batch(images), 8, 9)
+    return _pack_bits((means[:, :, 1:] > means[:, :, :-1]).reshape(len(images), 64))
+
+
+HASH_FUNCTIONS = {'ahash': ahash_batch, 'dhash': dhash_batch}
+
+
+# Number of differing bits between hash a and every hash in b
+def hamming_distance(a, b):
+    diff = np.bitwise_xor(np.asarray(b, dtype=np.uint64), np.uint64(a))
+    return _POPCOUNT[np.atleast_1d(diff).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+# Index of 64-bit hashes supporting "is there an entry within max_distance bits"
+# lookups. Each hash is split into max_distance + 1 chunks and stored in one
+# bucket per chunk: two hashes within max_distance bits must have at least one
+# chunk in common, so only the entries sharing a bucket need to be compared.
+class HashIndex(object):
+
+    def __init__(self, max_distance=4):
+        self.max_distance = max_distance
+        edges = np.linspace(0, 64, max_distance + 2).astype(int)
+        self._chunks = [(int(start), (1 << int(end - start)) - 1)
+                        for start, end in zip(edges[:-1], edges[1:])]
+        self._buckets = [{} for _ in self._chunks]
+        self._hashes = np.zeros(64, dtype=np.uint64)
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def _keys(self, hash_value):
+        hash_value = int(hash_value)
+        return [(hash_value >> shift) & mask for shift, mask in self._chunks]
+
+    # Add a hash with an associated value (e.g. a label), returns its id
+    def add(self, hash_value, value=None):
+        index = len(self.values)
+        if index == len(self._hashes):
+            self._hashes = np.concatenate([self._hashes, np.zeros_like(self._hashes)])
+        self._hashes[index] = hash_value
+        self.values.append(value)
+        for bucket, key in zip(self._buckets, self._keys(hash_value)):
+            bucket.setdefault(key, []).append(index)
+        return index
+
+    # Id of the closest stored hash within max_distance bits, or -1. The
+    # buckets only guarantee a shared chunk up to the index's max_distance,
+    # so a larger one cannot be answered.
+    def query(self, hash_value, max_distance=None):
+        if max_distance is None:
+            max_distance = self.max_distance
+        elif max_distance > self.max_distance:
+            raise ValueError('max_distance %d is larger than the index max_distance %d'
+                             % (max_distance, self.max_distance))
+        candidates = set()
+        for bucket, key in zip(self._buckets, self._keys(hash_value)):
+            candidates.update(bucket.get(key, ()))
+        if not candidates:
+            return -1
+        candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        distances = hamming_distance(hash_value, self._hashes[candidates])
+        best = int(np.argmin(distances))
+        if distances[best] > max_distance:
+            return -1
+        return int(candidates[best])
+
+
+# Indices of the images to keep so that no two kept images are within
+# max_distance bits of each other (the first image of each group is kept)
+def unique_indices(images, max_distance=4, method='dhash'):
+    hashes = HASH_FUNCTIONS[method](images)
+    index = HashIndex(max_distance)
+    keep = []
+    for i, hash_value in enumerate(hashes):
+        if index.query(hash_value) < 0:
+            index.add(hash_value, i)
+            keep.append(i)
+    return keep
+
+
+# Remove near-duplicate images from a STANDARDIZED_LIST of (image, label) pairs
+def deduplicate(standard_list, max_distance=4, method='dhash'):
+    if not standard_list:
+        return []
+    images = np.stack([item[0] for item in standard_list])
+    return [standard_list[i] for i in unique_indices(images, max_distance, method)]
+
+
+# Wraps a classifier function (like estimate_label) with a label cache: a crop
+# within max_distance bits of an already classified crop gets the cached label
+# instead of being classified again. Expects standardized images.
+class CachedClassifier(object):
+
+    def __init__(self, estimate_label, max_distance=2, method='dhash'):
+        self.classify = estimate_label
+        self.hash_function = HASH_FUNCTIONS[method]
+        self.index = HashIndex(max_distance)
+        self.hits = 0
+        self.misses = 0
+
+    # Same interface as estimate_label
+    def estimate_label(self, rgb_image):
+        return self.estimate_batch(np.asarray(rgb_image)[None])[0]
+
+    # One-hot labels for an (N, H, W, 3) batch of standardized images
+    def estimate_batch(self, images):
+        labels = []
+        for image, hash_value in zip(images, self.hash_function(images)):
+            match = self.index.query(hash_value)
+            if match >= 0:
+                self.hits += 1
+                label = self.index.values[match]
+            else:
+                self.misses += 1
+                label = self.classify(image)
+                self.index.add(hash_value, label)
+            labels.append(list(label))
+        return labels
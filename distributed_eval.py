@@ -0,0 +1,304 @@
+# Distributed evaluation: a coordinator and worker processes talking over TCP
+#
+# The coordinator splits a dataset into tasks (chunks of image files, or one
+# shard file per task). Workers connect, pull one task at a time, run
+# standardize_input + create_feature + estimate_label on every image and send
+# back compact results: (name, predicted class, true class, features).
+# Tasks of a worker that fails or disconnects are handed out again, up to
+# max_retries times, and the coordinator aggregates everything into the
+# accuracy and a list of misclassified images.
+#
+# Messages are length-prefixed JSON, so no pickled data crosses the network.
+#
+# Example on one machine:
+#   summary = distributed_eval.run_local(IMAGE_DIR_TEST, 4, standardize_input,
+#                                        create_feature, estimate_label)
+#   print('Accuracy: ' + str(summary['accuracy']))
+
+import collections
+import json
+import multiprocessing
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import shards
+from batch_features import index_to_one_hot, one_hot_to_index
+from dataset_files import IMAGE_TYPES, list_dataset_files, read_image
+
+MESSAGE_HEADER = struct.Struct('<I')
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(MESSAGE_HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+# Receive one message, or None if the connection was closed
+def recv_message(sock):
+    header = _recv_exactly(sock, MESSAGE_HEADER.size)
+    if header is None:
+        return None
+    size, = MESSAGE_HEADER.unpack(header)
+    data = _recv_exactly(sock, size)
+    if data is None:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+# Split a dataset into tasks. `dataset` is either an image directory laid out
+# like traffic_light_images/test/, or a list of shard files (one task each).
+def make_tasks(dataset, task_size=256):
+    if isinstance(dataset, str) and not dataset.endswith(shards.SHARD_SUFFIX):
+        files = list_dataset_files(dataset)
+        return [{'kind': 'files', 'items': files[start:start + task_size]}
+                for start in range(0, len(files), task_size)]
+    if isinstance(dataset, str):
+        dataset = [dataset]
+    return [{'kind': 'shard', 'items': [path]} for path in dataset]
+
+
+# (name, image, label) triples of the images of a task
+def _task_images(task):
+    if task['kind'] == 'files':
+        for path, label in task['items']:
+            yield path, read_image(path), label
+    else:
+        for path in task['items']:
+            for i, (image, label) in enumerate(shards.ShardReader([path], prefetch=1)):
+                yield '%s:%d' % (path, i), image, label
+
+
+# Classify every image of a task; returns [name, predicted, true, features] rows
+def run_task(task, standardize_input, create_feature, estimate_label):
+    results = []
+    for name, image, label in _task_images(task):
+        standard_im = standardize_input(image)
+        features = [float(x) for x in create_feature(standard_im)] if create_feature else []
+        predicted = one_hot_to_index(estimate_label(standard_im))
+        results.append([name, predicted, IMAGE_TYPES.index(label), features])
+    return results
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    # Only the attempt handed to this connection is retried when it fails:
+    # after a timeout the task may already be running elsewhere
+    def handle(self):
+        coordinator = self.server.coordinator
+        task_id = attempt = None
+        try:
+            while True:
+                message = recv_message(self.request)
+                if message is None:
+                    break
+                if message['type'] == 'get':
+                    task_id, attempt, reply = coordinator._next_task()
+                    send_message(self.request, reply)
+                elif message['type'] == 'result':
+                    coordinator._complete(message['id'], message['results'])
+                    task_id = attempt = None
+                elif message['type'] == 'error':
+                    if message['id'] == task_id:
+                        coordinator._retry(task_id, attempt, message['message'])
+                    task_id = attempt = None
+        except (OSError, ValueError) as e:
+            if task_id is not None:
+                coordinator._retry(task_id, attempt, 'connection error: ' + str(e))
+                task_id = attempt = None
+        finally:
+            if task_id is not None:
+                coordinator._retry(task_id, attempt, 'worker disconnected')
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# Hands out tasks to workers and aggregates their results. A task that fails,
+# whose worker disconnects, or that takes longer than task_timeout seconds is
+# given to another worker, at most max_retries times. _in_flight maps every
+# running task to its current (attempt, deadline), so a failure reported for
+# an earlier attempt never affects the one that replaced it.
+class Coordinator(object):
+
+    def __init__(self, tasks, host='127.0.0.1', port=0, max_retries=3, task_timeout=None):
+        self.tasks = list(tasks)
+        self.max_retries = max_retries
+        self.task_timeout = task_timeout
+        self._pending = collections.deque(range(len(self.tasks)))
+        self._in_flight = {}
+        self._attempts = [0] * len(self.tasks)
+        self._results = {}
+        self.failed = {}
+        self._condition = threading.Condition()
+        self._server = _Server((host, port), _Handler)
+        self._server.coordinator = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _finished(self):
+        return not self._pending and not self._in_flight
+
+    def _next_task(self):
+        with self._condition:
+            # Give up on workers that have held a task for too long
+            if self.task_timeout is not None:
+                now = time.time()
+                for task_id, (attempt, deadline) in list(self._in_flight.items()):
+                    if now > deadline:
+                        self._retry_locked(task_id, attempt, 'task timed out')
+            if self._pending:
+                task_id = self._pending.popleft()
+                self._attempts[task_id] += 1
+                attempt = self._attempts[task_id]
+                timeout = self.task_timeout if self.task_timeout is not None else float('inf')
+                self._in_flight[task_id] = (attempt, time.time() + timeout)
+                reply = dict(self.tasks[task_id], type='task', id=task_id)
+                return task_id, attempt, reply
+            if self._finished():
+                return None, None, {'type': 'done'}
+            # Other workers still have tasks that may need to be retried
+            return None, None, {'type': 'wait'}
+
+    # The results of any attempt complete the task: one that timed out may
+    # still be completed by its first worker, even after it was given up on
+    def _complete(self, task_id, results):
+        with self._condition:
+            if task_id in self._results:
+                return
+            self.failed.pop(task_id, None)
+            self._in_flight.pop(task_id, None)
+            if task_id in self._pending:
+                self._pending.remove(task_id)
+            self._results[task_id] = results
+            self._condition.notify_all()
+
+    # Requeue (or give up on) a task if `attempt` is still its running attempt
+    def _retry_locked(self, task_id, attempt, reason):
+        if task_id not in self._in_flight or self._in_flight[task_id][0] != attempt:
+            return
+        del self._in_flight[task_id]
+        if self._attempts[task_id] > self.max_retries:
+            self.failed[task_id] = reason
+        else:
+            self._pending.append(task_id)
+        self._condition.notify_all()
+
+    def _retry(self, task_id, attempt, reason):
+        with self._condition:
+            self._retry_locked(task_id, attempt, reason)
+
+    # Wait until every task has finished or failed, then return the summary
+    def wait(self, timeout=None):
+        with self._condition:
+            if not self._condition.wait_for(self._finished, timeout):
+                raise RuntimeError('Distributed evaluation did not finish in time')
+        return self.summary()
+
+    def close(self):
+        # shutdown() waits for serve_forever, so only call it once started
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+        self._server.server_close()
+
+    # Accuracy, misclassified (name, predicted_label, true_label) entries and
+    # the brightness features of every result received so far
+    def summary(self):
+        with self._condition:
+            rows = [row for task_id in sorted(self._results) for row in self._results[task_id]]
+            failed = dict(self.failed)
+        total = len(rows)
+        misclassified = [(name, index_to_one_hot(predicted), index_to_one_hot(true))
+                         for name, predicted, true, _ in rows if predicted != true]
+        return {
+            'total': total,
+            'accuracy': (total - len(misclassified)) / total if total else 0.0,
+            'misclassified': misclassified,
+            'features': dict((row[0], row[3]) for row in rows),
+            'failed_tasks': failed,
+        }
+
+
+def _connect(address, retries=50, delay=0.1):
+    for attempt in range(retries):
+        try:
+            return socket.create_connection(address)
+        except OSError:
+            if attempt == retries - 1:
+                raise
+            time.sleep(delay)
+
+
+# Worker loop: pull tasks from the coordinator until there are none left
+def run_worker(address, standardize_input, create_feature, estimate_label):
+    sock = _connect(tuple(address))
+    try:
+        while True:
+            send_message(sock, {'type': 'get'})
+            message = recv_message(sock)
+            if message is None or message['type'] == 'done':
+                break
+            if message['type'] == 'wait':
+                time.sleep(0.05)
+                continue
+            try:
+                results = run_task(message, standardize_input, create_feature, estimate_label)
+            except Exception as e:
+                send_message(sock, {'type': 'error', 'id': message['id'], 'message': repr(e)})
+            else:
+                send_message(sock, {'type': 'result', 'id': message['id'], 'results': results})
+    finally:
+        sock.close()
+
+
+# Run a coordinator and num_workers worker processes on this machine.
+# Uses the fork start method (where available) so functions defined in the
+# notebook can be handed to the workers.
+def run_local(dataset, num_workers, standardize_input, create_feature, estimate_label,
+              task_size=256, max_retries=3, task_timeout=None, timeout=None):
+    coordinator = Coordinator(make_tasks(dataset, task_size), max_retries=max_retries,
+                              task_timeout=task_timeout).start()
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    workers = [context.Process(target=run_worker,
+                               args=(coordinator.address, standardize_input,
+                                     create_feature, estimate_label))
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        return coordinator.wait(timeout)
+    finally:
+        coordinator.close()
+        for worker in workers:
+            worker.join(1.0)
+            if worker.is_alive():
+                worker.terminate()
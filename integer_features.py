@@ -0,0 +1,114 @@
+# Integer-only brightness feature and classification rules
+#
+# create_feature divides every band sum by the band area and estimate_label
+# compares the float averages, including the float average of yellow and
+# green. Edge CPUs without a strong FPU can do the same with integers only:
+# the band sums S are kept as uint32 (per-pixel R + G + B sums are uint16,
+# the HSV image and mask uint8), and every comparison of averages
+# S_a / (R_a * W) is cross-multiplied by the band rows R and the crop width W:
+#   red > yellow                            <=>  Sr*Ry > Sy*Rr
+#   red + thrsh > (yellow + green) / 2      <=>  2*Sr*Ry*Rg + 2*thrsh*W*Rr*Ry*Rg > Sy*Rr*Rg + Sg*Rr*Ry
+# The products fit in uint32 for 32x32 images (uint64 is used when a larger
+# geometry could overflow). The labels are the same as the float path's except
+# at exact ties of the thrsh rule (red + thrsh == (yellow + green) / 2): there
+# the strict integer comparison gives "not red", the exact result of the rule,
+# while the float path can return red when the averages round up. Such ties
+# need band sums that match to the last unit and do not occur in practice;
+# verify() checks the labels on random images.
+#
+# Example:
+#   predicted = integer_features.estimate_label_int(image)   # like estimate_label
+#   print(integer_features.verify(estimate_label))           # 0 mismatches
+
+import numpy as np
+
+import batch_features
+from batch_features import THRSH, band_sums_batch
+
+
+# Band sums of a single image (integer version of create_feature)
+def band_sums(rgb_image, **kwargs):
+    sums, rows, width = band_sums_batch(rgb_image[None], **kwargs)
+    return sums[0], rows, width
+
+
+# Smallest unsigned type holding every cross product of the rules
+def _product_dtype(rows, width, thrsh):
+    red_rows, yellow_rows, green_rows = rows
+    # Band sums are at most 3 * 255 * rows * width, so the largest term is
+    # the left-hand side of the thrsh rule
+    largest = 2 * width * red_rows * yellow_rows * green_rows * (3 * 255 + thrsh)
+    return np.uint32 if largest < 2 ** 32 else np.uint64
+
+
+# Integer version of batch_features.estimate_label_batch: takes (N, 3) band
+# sums, the band rows and the crop width, and returns (N,) class indices
+def estimate_label_int_batch(sums, rows, width, thrsh=THRSH):
+    if int(thrsh) != thrsh:
+        raise ValueError('The integer rules need an integer thrsh, got ' + str(thrsh))
+    thrsh = int(thrsh)
+    dtype = _product_dtype(rows, width, thrsh)
+    red_rows, yellow_rows, green_rows = (dtype(r) for r in rows)
+    red = sums[:, 0].astype(dtype)
+    yellow = sums[:, 1].astype(dtype)
+    green = sums[:, 2].astype(dtype)
+
+    # Each average scaled by the rows of the other band of the comparison
+    red_vs_yellow, yellow_vs_red = red * yellow_rows, yellow * red_rows
+    red_vs_green, green_vs_red = red * green_rows, green * red_rows
+    yellow_vs_green, green_vs_yellow = yellow * green_rows, green * yellow_rows
+
+    is_red = (red_vs_yellow > yellow_vs_red) & (red_vs_green > green_vs_red)
+    # Special case: red + thrsh > (yellow + green) / 2, multiplied by 2 * W * Rr * Ry * Rg
+    special = (red_vs_yellow > yellow_vs_red) & (red_vs_green < green_vs_red)
+    lhs = dtype(2) * red_vs_yellow * green_rows + dtype(2 * thrsh * width) * red_rows * yellow_rows * green_rows
+    rhs = yellow_vs_red * green_rows + green_vs_red * yellow_rows
+    is_red |= special & (lhs > rhs)
+    is_yellow = (red_vs_yellow < yellow_vs_red) & (yellow_vs_green > green_vs_yellow)
+    is_green = (red_vs_green < green_vs_red) & (yellow_vs_green < green_vs_yellow)
+    labels = np.select([is_red, is_yellow, is_green], [0, 1, 2], default=1)
+    return labels
+
+
+# (N,) class indices of an (N, H, W, 3) uint8 batch using integers only
+def predict_batch_int(images, thrsh=THRSH, **kwargs):
+    sums, rows, width = band_sums_batch(images, **kwargs)
+    return estimate_label_int_batch(sums, rows, width, thrsh)
+
+
+# Drop-in replacement for the notebook's estimate_label (one-hot label)
+def estimate_label_int(rgb_image, thrsh=THRSH):
+    return batch_features.index_to_one_hot(predict_batch_int(rgb_image[None], thrsh)[0])
+
+
+# Random (N, size, size, 3) images whose three bands get random brightness,
+# so all rules and many near-ties are exercised
+def _random_images(num_images, size, rng):
+    images = rng.integers(0, 256, (num_images, size, size, 3)).astype(np.float32)
+    scale = rng.random((num_images, 3)).astype(np.float32)
+    band = np.minimum(np.arange(size) * 3 // size, 2)
+    images *= scale[:, band][:, :, None, None]
+    return images.astype(np.uint8)
+
+
+# Number of images whose integer label differs from the float label, on
+# random images of every size (drawn in chunks of batch_features.CHUNK_SIZE).
+# The float labels come from the notebook's estimate_label when given, from
+# batch_features otherwise.
+def verify(estimate_label=None, num_images=20000, sizes=(32,), seed=0):
+    rng = np.random.default_rng(seed)
+    mismatches = 0
+    for size in sizes:
+        for start in range(0, num_images, batch_features.CHUNK_SIZE):
+            mismatches += _mismatches(estimate_label, min(batch_features.CHUNK_SIZE, num_images - start),
+                                      size, rng)
+    return mismatches
+
+
+def _mismatches(estimate_label, num_images, size, rng):
+    images = _random_images(num_images, size, rng)
+    if estimate_label is None:
+        expected = batch_features.estimate_label_batch(batch_features.brightness_features(images))
+    else:
+        expected = np.array([batch_features.one_hot_to_index(estimate_label(image)) for image in images])
+    return int(np.sum(predict_batch_int(images) != expected))
@@ -0,0 +1,151 @@
+# Lazily decoded dataset with a memory-bounded image cache
+#
+# helpers.load_dataset decodes every image up front and keeps all of them in
+# IMAGE_LIST. LazyDataset lists the files only and decodes an image the first
+# time it is accessed. Decoded images are kept in an LRU cache bounded in
+# bytes, so resident memory stays flat however large the dataset is, and the
+# next `prefetch` images can be decoded ahead on background threads while
+# the dataset is walked in order.
+#
+# It is a sequence of (image, label) pairs, so it can replace IMAGE_LIST:
+#   IMAGE_LIST = lazy_dataset.load_dataset(IMAGE_DIR_TRAINING, prefetch=64)
+#   selected_image = IMAGE_LIST[img_num][0]
+#   STANDARDIZED_LIST = standardize(IMAGE_LIST)
+
+import collections
+import collections.abc
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dataset_files import list_dataset_files, read_image
+
+# Default cache budget for decoded images
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+
+# Least recently used cache of arrays, bounded by their total nbytes
+class LRUCache(object):
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key).nbytes
+            self._items[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+class LazyDataset(collections.abc.Sequence):
+
+    # files is a list of (path, label) pairs, as returned by
+    # dataset_files.list_dataset_files. prefetch is the number of following
+    # images decoded ahead of every access (0 disables prefetching).
+    def __init__(self, files, max_bytes=MAX_CACHE_BYTES, prefetch=0, num_threads=2,
+                 read_image=read_image):
+        self.files = list(files)
+        self.cache = LRUCache(max_bytes)
+        self.prefetch = prefetch
+        self.read_image = read_image
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(num_threads) if prefetch else None
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('dataset index out of range')
+        image = self._image(index)
+        self._prefetch_after(index)
+        return image, self.files[index][1]
+
+    def label(self, index):
+        return self.files[index][1]
+
+    def _image(self, index):
+        image = self.cache.get(index)
+        if image is not None:
+            return image
+        with self._lock:
+            future = self._pending.get(index)
+        if future is not None:
+            return future.result()
+        image = self.read_image(self.files[index][0])
+        self.cache.put(index, image)
+        return image
+
+    def _load(self, index):
+        try:
+            image = self.read_image(self.files[index][0])
+            self.cache.put(index, image)
+            return image
+        finally:
+            with self._lock:
+                self._pending.pop(index, None)
+
+    def _prefetch_after(self, index):
+        if not self.prefetch:
+            return
+        for i in range(index + 1, min(index + 1 + self.prefetch, len(self))):
+            if i in self.cache:
+                continue
+            with self._lock:
+                if i in self._pending:
+                    continue
+                self._pending[i] = self._executor.submit(self._load, i)
+
+    # Drop the decoded images and stop the prefetch threads
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self.prefetch = 0
+        self.cache.clear()
+
+    def stats(self):
+        return {'images': len(self), 'cached': len(self.cache), 'cached_bytes': self.cache.nbytes,
+                'hits': self.cache.hits, 'misses': self.cache.misses,
+                'evictions': self.cache.evictions}
+
+
+# Drop-in replacement for helpers.load_dataset that decodes on access
+def load_dataset(image_dir, **kwargs):
+    return LazyDataset(list_dataset_files(image_dir), **kwargs)
@@ -0,0 +1,228 @@
+# Memory profiling of the pipeline stages
+#
+# Loading the dataset, building STANDARDIZED_LIST and collecting MISCLASSIFIED
+# all keep full lists of images alive. MemoryProfiler records, for every stage
+# it wraps:
+#   - the peak of traced Python/NumPy allocations during the stage
+#   - the change in resident set size (RSS), and the peak RSS during the stage
+#     (sampled by a background thread every sample_interval seconds)
+#   - the source lines that allocated the most memory during the stage
+# and can name the variables that hold the most bytes afterwards. The report
+# is written as JSON, and diff_reports() compares two reports stage by stage.
+#
+# Example (in the notebook):
+#   profiler = memory_profile.MemoryProfiler()
+#   with profiler.stage('load_dataset'):
+#       IMAGE_LIST = helpers.load_dataset(IMAGE_DIR_TRAINING)
+#   with profiler.stage('standardize'):
+#       STANDARDIZED_LIST = standardize(IMAGE_LIST)
+#   with profiler.stage('get_misclassified_images'):
+#       MISCLASSIFIED = get_misclassified_images(STANDARDIZED_TEST_LIST)
+#   profiler.record_holders(globals())
+#   profiler.save('memory_report.json')
+#   print(profiler.summary())
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Current resident set size in bytes (0 if it cannot be read)
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return 0
+
+
+# Peak resident set size of the whole process so far, in bytes
+def peak_rss():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Approximate number of bytes held by an object: NumPy buffers plus the
+# containers (lists, tuples, dicts) around them. Shared objects are counted
+# once, and so is the buffer behind many views of one array (as returned by
+# synthetic.generate or packed_store.load_standardized).
+def deep_size(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    # For NumPy arrays that own their data this includes the data buffer
+    size = sys.getsizeof(obj)
+    if isinstance(obj, np.ndarray) and not obj.flags.owndata:
+        # A view: count the buffer of the array that owns it, once
+        owner = obj
+        while isinstance(owner.base, np.ndarray):
+            owner = owner.base
+        if owner is obj:
+            # Wraps a non-NumPy buffer (bytes, mmap)
+            size += obj.nbytes
+        elif id(owner) not in seen:
+            seen.add(id(owner))
+            size += owner.nbytes
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+class MemoryProfiler(object):
+
+    def __init__(self, top_sites=10, frames=1, sample_interval=0.01):
+        self.top_sites = top_sites
+        self.frames = frames
+        self.sample_interval = sample_interval
+        self.stages = []
+        self.holders = []
+
+    # Profile the code inside a `with` block as one stage
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = tracemalloc.is_tracing()
+        if not started:
+            tracemalloc.start(self.frames)
+        if hasattr(tracemalloc, 'reset_peak'):
+            # Python 3.9+: measure the peak of this stage only
+            tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        traced_before = tracemalloc.get_traced_memory()[0]
+        rss_before = current_rss()
+        rss_samples = [rss_before]
+        done = threading.Event()
+        sampler = threading.Thread(target=self._sample_rss, args=(rss_samples, done))
+        sampler.daemon = True
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            done.set()
+            sampler.join()
+            traced_after, traced_peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            rss_after = current_rss()
+            if not started:
+                tracemalloc.stop()
+
+            sites = []
+            # Leave out the profiler's own allocations (including its sampler thread)
+            filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+                       tracemalloc.Filter(False, threading.__file__),
+                       tracemalloc.Filter(False, __file__)]
+            for stat in after.filter_traces(filters).compare_to(before.filter_traces(filters),
+                                                               'lineno')[:self.top_sites]:
+                frame = stat.traceback[0]
+                sites.append({'site': '%s:%d' % (frame.filename, frame.lineno),
+                              'size_diff': stat.size_diff,
+                              'count_diff': stat.count_diff})
+            self.stages.append({
+                'stage': name,
+                'seconds': elapsed,
+                'traced_peak': traced_peak - traced_before,
+                'traced_diff': traced_after - traced_before,
+                'rss_diff': rss_after - rss_before,
+                'rss_peak': max(rss_samples[0], rss_after),
+                'process_rss_peak': peak_rss(),
+                'top_sites': sites,
+            })
+
+    # Runs on a background thread during a stage: keeps the largest RSS seen
+    # in samples[0]
+    def _sample_rss(self, samples, done):
+        while not done.wait(self.sample_interval):
+            samples[0] = max(samples[0], current_rss())
+
+    # Record the variables of a namespace (e.g. globals()) holding the most bytes
+    def record_holders(self, namespace, top=10):
+        sizes = []
+        for name, value in namespace.items():
+            if name.startswith('_') or callable(value) or type(value).__name__ == 'module':
+                continue
+            sizes.append((deep_size(value), name, type(value).__name__))
+        sizes.sort(reverse=True)
+        self.holders = [{'name': name, 'type': type_name, 'bytes': size}
+                        for size, name, type_name in sizes[:top]]
+        return self.holders
+
+    def report(self):
+        return {'stages': self.stages, 'holders': self.holders}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def summary(self):
+        return format_report(self.report())
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _mb(size):
+    return '%.1f MB' % (size / float(1 << 20))
+
+
+# Human-readable table of a report
+def format_report(report):
+    lines = ['%-28s %10s %12s %12s %12s' % ('stage', 'seconds', 'traced peak', 'rss change', 'rss peak')]
+    for stage in report['stages']:
+        lines.append('%-28s %10.3f %12s %12s %12s' % (
+            stage['stage'], stage['seconds'], _mb(stage['traced_peak']),
+            _mb(stage['rss_diff']), _mb(stage['rss_peak'])))
+        for site in stage['top_sites'][:3]:
+            lines.append('    %+10.1f MB  %s' % (site['size_diff'] / float(1 << 20), site['site']))
+    if report.get('holders'):
+        lines.append('')
+        lines.append('Largest data structures:')
+        for holder in report['holders']:
+            lines.append('    %-24s %-12s %12s' % (holder['name'], holder['type'], _mb(holder['bytes'])))
+    return '\n'.join(lines)
+
+
+# Compare two reports (dicts or JSON paths) stage by stage
+def diff_reports(old, new):
+    if isinstance(old, str):
+        old = load_report(old)
+    if isinstance(new, str):
+        new = load_report(new)
+    old_stages = dict((stage['stage'], stage) for stage in old['stages'])
+    lines = ['%-28s %14s %14s %14s' % ('stage', 'traced peak', 'rss change', 'seconds')]
+    for stage in new['stages']:
+        previous = old_stages.get(stage['stage'])
+        if previous is None:
+            lines.append('%-28s %14s %14s %14s' % (stage['stage'], 'new', 'new', 'new'))
+            continue
+        lines.append('%-28s %14s %14s %+13.3fs' % (
+            stage['stage'],
+            '%+.1f MB' % ((stage['traced_peak'] - previous['traced_peak']) / float(1 << 20)),
+            '%+.1f MB' % ((stage['rss_diff'] - previous['rss_diff']) / float(1 << 20)),
+            stage['seconds'] - previous['seconds']))
+    return '\n'.join(lines)
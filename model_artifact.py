@@ -0,0 +1,251 @@
+# Compiled, memory-mappable classifier artifact
+#
+# The classifier is defined by a handful of parameters (the HSV thresholds,
+# crop offsets, band rows and the estimate_label threshold). compile_model()
+# stores them in a single file together with a version, a hash and
+# precomputed tables, so a worker can start classifying right after mapping
+# the file instead of rebuilding anything:
+#
+#   b'TLMODEL1', '<II' (format version, header size), JSON header,
+#   padding to a 64-byte boundary, table data
+#
+# The main table is the colour-mask LUT: for every 24-bit RGB colour, 1 if the
+# pixel is kept by the brightness feature (outside the low/high HSV
+# thresholds). With it the per-image HSV conversion and cv2.inRange become a
+# single table lookup. load_model() maps the file read-only, so loading takes
+# well under a millisecond and the LUT pages are shared between processes.
+#
+# ModelHandle holds the current model and swaps in a new artifact without
+# interrupting requests that are already running with the old one.
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+
+import cv2
+import numpy as np
+
+import batch_features
+
+MAGIC = b'TLMODEL1'
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct('<II')
+ALIGNMENT = 64
+
+
+# Keep flag of every RGB colour, indexed by (r << 16) | (g << 8) | b
+def build_mask_lut(low_thrsh, high_thrsh):
+    colours = np.arange(1 << 24, dtype=np.uint32)
+    rgb = np.empty((1 << 24, 3), dtype=np.uint8)
+    rgb[:, 0] = colours >> 16
+    rgb[:, 1] = (colours >> 8) & 0xff
+    rgb[:, 2] = colours & 0xff
+    hsv = cv2.cvtColor(rgb.reshape(4096, 4096, 3), cv2.COLOR_RGB2HSV)
+    mask = cv2.inRange(hsv, np.asarray(low_thrsh), np.asarray(high_thrsh))
+    return (mask.ravel() == 0).astype(np.uint8)
+
+
+def _params_hash(params, tables):
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8'))
+    for name in sorted(tables):
+        digest.update(name.encode('utf-8'))
+        digest.update(np.ascontiguousarray(tables[name]).tobytes())
+    return digest.hexdigest()
+
+
+def _build(low_thrsh, high_thrsh, crop_x, crop_y, band_rows, thrsh, standard_size):
+    params = {
+        'standard_size': int(standard_size),
+        'low_thrsh': [int(x) for x in low_thrsh],
+        'high_thrsh': [int(x) for x in high_thrsh],
+        'crop_x': int(crop_x),
+        'crop_y': int(crop_y),
+        'band_rows': [[int(start), int(end)] for start, end in band_rows],
+        'thrsh': float(thrsh),
+    }
+    tables = {'mask_lut': build_mask_lut(low_thrsh, high_thrsh)}
+    return params, tables
+
+
+# Write a model artifact. Parameters default to the ones used in the notebook.
+# The crop and band geometry is given for standard_size x standard_size images
+# and is scaled to the size of the images being classified.
+# The file is written next to `path` and renamed into place, so a running
+# process never sees a partially written artifact.
+def compile_model(path, version='1', low_thrsh=batch_features.LOW_THRSH,
+                  high_thrsh=batch_features.HIGH_THRSH, crop_x=batch_features.CROP_X,
+                  crop_y=batch_features.CROP_Y, band_rows=batch_features.BAND_ROWS,
+                  thrsh=batch_features.THRSH, standard_size=32):
+    params, tables = _build(low_thrsh, high_thrsh, crop_x, crop_y, band_rows, thrsh, standard_size)
+
+    # Table offsets are relative to the (aligned) start of the table data
+    layout = {}
+    offset = 0
+    for name in sorted(tables):
+        table = tables[name]
+        layout[name] = {'offset': offset, 'shape': list(table.shape), 'dtype': table.dtype.str}
+        offset += -(-table.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({
+        'version': str(version),
+        'params': params,
+        'tables': layout,
+        'sha256': _params_hash(params, tables),
+    }, sort_keys=True).encode('utf-8')
+    data_start = len(MAGIC) + PREAMBLE.size + len(header)
+    data_start = -(-data_start // ALIGNMENT) * ALIGNMENT
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(PREAMBLE.pack(FORMAT_VERSION, len(header)))
+        f.write(header)
+        for name in sorted(tables):
+            f.seek(data_start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(tables[name]).tobytes())
+    os.replace(tmp_path, path)
+    return path
+
+
+# A loaded artifact: the parameters plus read-only views of the mapped tables
+class ClassifierModel(object):
+
+    # mtime_ns is the modification time of the mapped file, if any
+    def __init__(self, header, tables, path=None, mtime_ns=None):
+        self.version = header['version']
+        self.sha256 = header['sha256']
+        self.params = header['params']
+        self.tables = tables
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.mask_lut = tables['mask_lut']
+        self.band_rows = [tuple(rows) for rows in self.params['band_rows']]
+        self._geometry = {}
+
+    # Recompute the hash of the parameters and tables (reads every table page)
+    def verify(self):
+        return _params_hash(self.params, self.tables) == self.sha256
+
+    # Boolean (..., H, W) keep mask of RGB images, from the colour LUT
+    def keep_mask(self, images):
+        images = np.asarray(images)
+        index = images[..., 0].astype(np.uint32)
+        index <<= 8
+        index |= images[..., 1]
+        index <<= 8
+        index |= images[..., 2]
+        return self.mask_lut[index].view(np.bool_)
+
+    # Same result as batch_features.brightness_features with these parameters,
+    # with the geometry scaled to the image size like band_geometry does.
+    # Only the pixels inside the bands are looked up in the LUT.
+    def brightness_features(self, images):
+        h, w = images.shape[1:3]
+        if (h, w) not in self._geometry:
+            # Artifacts written before standard_size was stored are for 32x32
+            crop_x, crop_y, band_rows = batch_features.scale_geometry(
+                self.params['crop_x'], self.params['crop_y'], self.band_rows, h, w,
+                self.params.get('standard_size', 32))
+            rows, (col_start, col_end) = batch_features.band_slices(h, w, crop_x, crop_y, band_rows)
+            top = min(start for start, _ in rows)
+            bottom = max(end for _, end in rows)
+            # Band rows relative to the region, and the band areas
+            region_rows = [(start - top, end - top) for start, end in rows]
+            areas = np.array([(end - start) * (col_end - col_start) for start, end in rows],
+                             dtype=np.float64)
+            self._geometry[h, w] = (top, bottom, col_start, col_end, region_rows, areas)
+        top, bottom, col_start, col_end, rows, areas = self._geometry[h, w]
+        region = images[:, top:bottom, col_start:col_end]
+        sums = batch_features.masked_band_sums(region, self.keep_mask(region), rows,
+                                               (0, col_end - col_start))
+        return sums / areas
+
+    # Class indices for an (N, H, W, 3) batch of standardized images
+    def predict_batch(self, images):
+        return batch_features.estimate_label_batch(self.brightness_features(images),
+                                                   self.params['thrsh'])
+
+    # Same interface as create_feature
+    def create_feature(self, rgb_image):
+        return list(self.brightness_features(np.asarray(rgb_image)[None])[0])
+
+    # Same interface as estimate_label
+    def estimate_label(self, rgb_image):
+        return batch_features.index_to_one_hot(self.predict_batch(np.asarray(rgb_image)[None])[0])
+
+
+# Build a model in memory, without writing an artifact (same parameters as
+# compile_model)
+def build_model(version='1', low_thrsh=batch_features.LOW_THRSH,
+                high_thrsh=batch_features.HIGH_THRSH, crop_x=batch_features.CROP_X,
+                crop_y=batch_features.CROP_Y, band_rows=batch_features.BAND_ROWS,
+                thrsh=batch_features.THRSH, standard_size=32):
+    params, tables = _build(low_thrsh, high_thrsh, crop_x, crop_y, band_rows, thrsh, standard_size)
+    header = {'version': str(version), 'params': params, 'sha256': _params_hash(params, tables)}
+    return ClassifierModel(header, tables)
+
+
+# Map an artifact read-only and return a ClassifierModel. The tables are views
+# into the mapping, so nothing is copied or decoded up front.
+def load_model(path, verify=False):
+    with open(path, 'rb') as f:
+        # Stat the file that is mapped, not whatever is at `path` afterwards
+        mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a classifier model artifact: ' + path)
+    format_version, header_size = PREAMBLE.unpack_from(mapped, len(MAGIC))
+    if format_version != FORMAT_VERSION:
+        raise ValueError('Unsupported model artifact format version %d' % format_version)
+    header_start = len(MAGIC) + PREAMBLE.size
+    header = json.loads(mapped[header_start:header_start + header_size].decode('utf-8'))
+    data_start = -(-(header_start + header_size) // ALIGNMENT) * ALIGNMENT
+
+    tables = {}
+    for name, layout in header['tables'].items():
+        dtype = np.dtype(layout['dtype'])
+        count = int(np.prod(layout['shape']))
+        tables[name] = np.frombuffer(mapped, dtype=dtype, count=count,
+                                     offset=data_start + layout['offset']).reshape(layout['shape'])
+    model = ClassifierModel(header, tables, path, mtime_ns)
+    if verify and not model.verify():
+        raise ValueError('Model artifact hash does not match its contents: ' + path)
+    return model
+
+
+# Holds the current model of a running process. Each call takes a reference to
+# the current model once, so swapping in a new artifact never affects a call
+# that is already running; the old mapping is released when its last user is
+# done with it.
+class ModelHandle(object):
+
+    def __init__(self, path, verify=False):
+        self.verify = verify
+        self._lock = threading.Lock()
+        self.model = load_model(path, verify)
+
+    # Load another artifact (or the same path again) and make it current
+    def swap(self, path=None):
+        path = path or self.model.path
+        model = load_model(path, self.verify)
+        with self._lock:
+            self.model = model
+        return model
+
+    # Swap only if the artifact file was replaced since it was loaded
+    def reload_if_changed(self):
+        if os.stat(self.model.path).st_mtime_ns != self.model.mtime_ns:
+            return self.swap()
+        return None
+
+    def create_feature(self, rgb_image):
+        return self.model.create_feature(rgb_image)
+
+    def estimate_label(self, rgb_image):
+        return self.model.estimate_label(rgb_image)
+
+    def predict_batch(self, images):
+        return self.model.predict_batch(images)
@@ -0,0 +1,284 @@
+# Compressed packed-array storage for standardized images
+#
+# Standardized crops are only 32x32x3 bytes each, but a dataset of individual
+# image files costs one open/read/decode per image. A packed file stores the
+# whole STANDARDIZED_LIST as a few compressed chunks:
+#
+#   b'TLPACK01'
+#   chunks: compressed (images of the chunk as raw uint8, then their uint8
+#           class indices)
+#   index footer: JSON with the codec, image shape, image count and, per
+#                 chunk, [offset, compressed size, image count, crc32]
+#   '<Q' footer size, b'TLPKIDX1'
+#
+# Chunks are compressed with zstd or lz4 when the zstandard / lz4 packages are
+# installed, zlib otherwise. The crc32 of every decompressed chunk is checked.
+# load() reads the whole file with one sequential read and decompresses the
+# chunks in parallel threads straight into a preallocated (N, H, W, 3) array;
+# PackedReader also gives random access to single images through the index.
+#
+# Example:
+#   packed_store.save_standardized(STANDARDIZED_LIST, 'train.tlp')
+#   STANDARDIZED_LIST = packed_store.load_standardized('train.tlp')
+
+import json
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from batch_features import index_to_one_hot, one_hot_to_index
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+MAGIC = b'TLPACK01'
+INDEX_MAGIC = b'TLPKIDX1'
+FOOTER = struct.Struct('<Q')
+PACKED_SUFFIX = '.tlp'
+# Images per chunk: 4096 standardized images are 12 MB before compression
+CHUNK_IMAGES = 4096
+
+
+def available_codecs():
+    codecs = ['zlib']
+    if lz4 is not None:
+        codecs.insert(0, 'lz4')
+    if zstandard is not None:
+        codecs.insert(0, 'zstd')
+    return codecs
+
+
+def _compress(data, codec, level):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level or 3).compress(data)
+    if codec == 'lz4':
+        return lz4.frame.compress(data, compression_level=level or 0)
+    if codec == 'zlib':
+        return zlib.compress(data, 6 if level is None else level)
+    raise ValueError('Unknown codec: ' + str(codec))
+
+
+def _decompress(data, codec, size):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstandard is needed to read zstd compressed files')
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    if codec == 'lz4':
+        if lz4 is None:
+            raise ImportError('lz4 is needed to read lz4 compressed files')
+        return lz4.frame.decompress(data)
+    if codec == 'zlib':
+        return zlib.decompress(data, bufsize=size)
+    raise ValueError('Unknown codec: ' + str(codec))
+
+
+def _label_index(label):
+    if isinstance(label, (int, np.integer)):
+        return int(label)
+    return one_hot_to_index(label)
+
+
+# Writes standardized images (all of the same shape) and their labels into a
+# packed file. The file is written under a temporary name and renamed on
+# close(), so readers never see a partial file. Leaving a `with` block with an
+# exception (or calling abort()) deletes the temporary file instead.
+class PackedWriter(object):
+
+    def __init__(self, path, shape=(32, 32, 3), codec=None, level=None, chunk_images=CHUNK_IMAGES):
+        if codec is None:
+            codec = available_codecs()[0]
+        if codec not in ('zstd', 'lz4', 'zlib'):
+            raise ValueError('Unknown codec: ' + str(codec))
+        self.path = path
+        self.shape = tuple(shape)
+        self.codec = codec
+        self.level = level
+        self.chunk_images = chunk_images
+        self.count = 0
+        self._chunks = []
+        self._images = []
+        self._labels = []
+        self._tmp_path = path + '.tmp'
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    # Add one image; the label may be a one-hot list or a class index
+    def write(self, image, label):
+        if image.shape != self.shape:
+            raise ValueError('Expected an image of shape %s, got %s' % (self.shape, image.shape))
+        self._images.append(image)
+        self._labels.append(_label_index(label))
+        if len(self._images) >= self.chunk_images:
+            self._write_chunk(np.stack(self._images), np.array(self._labels))
+            self._images, self._labels = [], []
+
+    # Add an (N, H, W, 3) batch with its (N,) class indices
+    def write_batch(self, images, labels):
+        for image, label in zip(images, labels):
+            self.write(image, label)
+
+    def _write_chunk(self, images, labels):
+        payload = (np.ascontiguousarray(images, dtype=np.uint8).tobytes()
+                   + np.asarray(labels, dtype=np.uint8).tobytes())
+        data = _compress(payload, self.codec, self.level)
+        self._chunks.append([self._file.tell(), len(data), len(labels), zlib.crc32(payload)])
+        self._file.write(data)
+        self.count += len(labels)
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._images:
+            self._write_chunk(np.stack(self._images), np.array(self._labels))
+            self._images, self._labels = [], []
+        index = json.dumps({'codec': self.codec,
+                            'shape': list(self.shape),
+                            'count': self.count,
+                            'chunks': self._chunks}).encode('utf-8')
+        self._file.write(index)
+        self._file.write(FOOTER.pack(len(index)))
+        self._file.write(INDEX_MAGIC)
+        self._file.close()
+        self._file = None
+        os.replace(self._tmp_path, self.path)
+
+    # Stop writing and delete the temporary file, leaving `path` untouched
+    def abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self._tmp_path)
+
+
+def _parse_index(data):
+    if data[-len(INDEX_MAGIC):] != INDEX_MAGIC or data[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a complete packed file')
+    size, = FOOTER.unpack(data[-(FOOTER.size + len(INDEX_MAGIC)):-len(INDEX_MAGIC)])
+    end = len(data) - FOOTER.size - len(INDEX_MAGIC)
+    return json.loads(bytes(data[end - size:end]).decode('utf-8'))
+
+
+# Decompress one chunk (`chunk` is its [offset, size, count, crc32] index
+# entry, `data` its compressed bytes) into the images and labels arrays at
+# position `start`, checking the crc32
+def _unpack_chunk(data, codec, shape, chunk, images, labels, start):
+    _, _, count, crc = chunk
+    image_bytes = count * int(np.prod(shape))
+    try:
+        payload = _decompress(data, codec, image_bytes + count)
+    except ImportError:
+        raise
+    except Exception as e:
+        raise ValueError('Corrupt chunk at offset %d: %s' % (chunk[0], e))
+    if zlib.crc32(payload) != crc:
+        raise ValueError('Checksum mismatch in chunk at offset %d' % chunk[0])
+    payload = np.frombuffer(payload, dtype=np.uint8)
+    images[start:start + count] = payload[:image_bytes].reshape((count,) + tuple(shape))
+    labels[start:start + count] = payload[image_bytes:]
+
+
+# Load a whole packed file: one sequential read, then the chunks are
+# decompressed by num_threads threads (zlib and zstd release the GIL) into
+# one preallocated array. Returns (images, labels) with (N,) class indices.
+def load(path, num_threads=None):
+    with open(path, 'rb') as f:
+        data = memoryview(f.read())
+    index = _parse_index(data)
+    images = np.empty((index['count'],) + tuple(index['shape']), dtype=np.uint8)
+    labels = np.empty(index['count'], dtype=np.int64)
+    starts = np.cumsum([0] + [chunk[2] for chunk in index['chunks']])
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    with ThreadPoolExecutor(max(1, min(num_threads, len(index['chunks'])))) as executor:
+        futures = [executor.submit(_unpack_chunk, data[chunk[0]:chunk[0] + chunk[1]], index['codec'],
+                                   index['shape'], chunk, images, labels, start)
+                   for chunk, start in zip(index['chunks'], starts)]
+        for future in futures:
+            future.result()
+    return images, labels
+
+
+# Random access to the images of a packed file. Only the footer is read when
+# opening; every access reads and decompresses the chunk holding the image,
+# and the last chunk is kept so neighbouring images are cheap.
+class PackedReader(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('Not a packed file: ' + path)
+            f.seek(-(FOOTER.size + len(INDEX_MAGIC)), os.SEEK_END)
+            size, = FOOTER.unpack(f.read(FOOTER.size))
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError('Not a complete packed file: ' + path)
+            f.seek(-(size + FOOTER.size + len(INDEX_MAGIC)), os.SEEK_END)
+            self.index = json.loads(f.read(size).decode('utf-8'))
+        self.shape = tuple(self.index['shape'])
+        self._starts = np.cumsum([0] + [chunk[2] for chunk in self.index['chunks']])
+        self._cached = None
+
+    def __len__(self):
+        return self.index['count']
+
+    # (images, labels) of one chunk
+    def read_chunk(self, chunk):
+        if self._cached is not None and self._cached[0] == chunk:
+            return self._cached[1]
+        entry = self.index['chunks'][chunk]
+        offset, size, count, _ = entry
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+        images = np.empty((count,) + self.shape, dtype=np.uint8)
+        labels = np.empty(count, dtype=np.int64)
+        _unpack_chunk(data, self.index['codec'], self.shape, entry, images, labels, 0)
+        self._cached = (chunk, (images, labels))
+        return images, labels
+
+    # (image, class index) of image i
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('image index out of range')
+        chunk = int(np.searchsorted(self._starts, i, side='right')) - 1
+        images, labels = self.read_chunk(chunk)
+        position = i - self._starts[chunk]
+        return images[position], int(labels[position])
+
+
+# Save a STANDARDIZED_LIST of (image, one_hot_label) pairs
+def save_standardized(standard_list, path, **kwargs):
+    shape = standard_list[0][0].shape if standard_list else (32, 32, 3)
+    with PackedWriter(path, shape, **kwargs) as writer:
+        for image, label in standard_list:
+            writer.write(image, label)
+    return writer.count
+
+
+# Load a packed file back as a STANDARDIZED_LIST of (image, one_hot_label)
+# pairs (the images are views into one array)
+def load_standardized(path, num_threads=None):
+    images, labels = load(path, num_threads)
+    return [(image, index_to_one_hot(label)) for image, label in zip(images, labels)]
@@ -0,0 +1,206 @@
+# Performance regression tests for the classification pipeline
+#
+# Like the tests in test_functions.py, these take the notebook's functions as
+# arguments and print TEST PASSED / TEST FAILED. They time standardize,
+# create_feature, estimate_label and get_misclassified_images on a fixed
+# synthetic dataset, record the peak traced allocations of each stage, and
+# compare the results with absolute floors/ceilings and with a stored
+# baseline (perf_baseline.json), allowing some tolerance. Every stage is timed
+# in runs of at least MIN_RUN_SECONDS, each followed by a run of a fixed
+# reference workload, and the baseline comparison uses the median ratio of the
+# two: load from other processes or a clock-frequency change slows both down
+# and cancels out, so unchanged code does not fail the test.
+#
+# Example (in the notebook):
+#   import perf_tests
+#   perf = perf_tests.PerfTests()
+#   perf.test_performance(standardize, create_feature, estimate_label,
+#                         get_misclassified_images)
+#
+# The first run (or update_baseline=True) records the baseline. Throughput
+# depends on the machine, so the baseline is only meaningful on the machine
+# that recorded it: record a new one (update_baseline=True) on every machine
+# the tests run on, and do not share perf_baseline.json between machines.
+
+import json
+import os
+import statistics
+import time
+import tracemalloc
+import unittest
+
+import numpy as np
+
+from test_output import print_fail, print_pass
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perf_baseline.json')
+STAGES = ['standardize', 'create_feature', 'estimate_label', 'get_misclassified_images']
+
+# Images per second every stage must reach, on any reasonable machine
+THROUGHPUT_FLOORS = {
+    'standardize': 2000.0,
+    'create_feature': 2000.0,
+    'estimate_label': 2000.0,
+    'get_misclassified_images': 1000.0,
+}
+# Largest peak of traced allocations allowed per image, in bytes
+MEMORY_CEILINGS = {
+    'standardize': 8 * 1024,
+    'create_feature': 1024,
+    'estimate_label': 1024,
+    'get_misclassified_images': 4 * 1024,
+}
+# Shortest timed run: a stage is called repeatedly until this much time has
+# passed, which keeps timer resolution and scheduling noise small
+MIN_RUN_SECONDS = 0.5
+
+
+# Fixed synthetic dataset in the format returned by helpers.load_dataset:
+# (image, label) pairs of RGB crops of different sizes, with the lit lamp
+# drawn brighter than the rest of the housing
+def synthetic_dataset(num_images=1000, seed=0):
+    random_state = np.random.RandomState(seed)
+    labels = ['red', 'yellow', 'green']
+    colours = [(255, 40, 40), (255, 220, 40), (40, 255, 120)]
+    image_list = []
+    for _ in range(num_images):
+        height = random_state.randint(40, 120)
+        width = random_state.randint(20, 60)
+        image = random_state.randint(0, 60, (height, width, 3)).astype(np.uint8)
+        light = random_state.randint(3)
+        top = light * height // 3
+        image[top + height // 12:top + height // 4, width // 4:3 * width // 4] = colours[light]
+        image_list.append((image, labels[light]))
+    return image_list
+
+
+# Calls per second of a function, calling it until min_seconds have passed
+def _calls_per_second(function, min_seconds):
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return calls / elapsed
+
+
+# Fixed per-image Python + NumPy work that the stages are timed against
+def reference_workload(image_list):
+    return lambda: [float(image.astype(np.float32).mean()) for image, _ in image_list]
+
+
+# Record the peak traced allocations of a stage, then time it in `repeats`
+# runs, each followed by a run of the reference workload. Returns the median
+# throughput and the median throughput relative to the reference. The traced
+# run also warms up caches before the timing.
+def measure(stage, num_images, reference, repeats=10, min_seconds=MIN_RUN_SECONDS):
+    tracemalloc.start()
+    try:
+        stage()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    throughputs = []
+    relative = []
+    for _ in range(repeats):
+        throughput = num_images * _calls_per_second(stage, min_seconds)
+        throughputs.append(throughput)
+        relative.append(throughput / (num_images * _calls_per_second(reference, min_seconds)))
+    return {'throughput': statistics.median(throughputs), 'relative': statistics.median(relative),
+            'peak_bytes': peak}
+
+
+# Throughput (images per second) and peak bytes of every pipeline stage
+def profile_pipeline(standardize, create_feature, estimate_label, get_misclassified_images,
+                     image_list, repeats=10):
+    standardized_list = standardize(image_list)
+    images = [item[0] for item in standardized_list]
+    stages = {
+        'standardize': lambda: standardize(image_list),
+        'create_feature': lambda: [create_feature(im) for im in images],
+        'estimate_label': lambda: [estimate_label(im) for im in images],
+        'get_misclassified_images': lambda: get_misclassified_images(standardized_list),
+    }
+    reference = reference_workload(image_list)
+    return dict((name, measure(stages[name], len(image_list), reference, repeats)) for name in STAGES)
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+# List of problems found in the results, and a per-stage comparison table
+def compare(results, baseline, num_images, tolerance=0.25):
+    problems = []
+    lines = ['%-26s %14s %14s %9s %12s %12s %9s' % ('stage', 'images/s', 'baseline', 'change',
+                                                 'peak bytes', 'baseline', 'change')]
+    for name in STAGES:
+        current = results[name]
+        previous = (baseline or {}).get(name)
+        if current['throughput'] < THROUGHPUT_FLOORS[name]:
+            problems.append('%s: %.0f images/s is below the floor of %.0f'
+                            % (name, current['throughput'], THROUGHPUT_FLOORS[name]))
+        ceiling = MEMORY_CEILINGS[name] * num_images
+        if current['peak_bytes'] > ceiling:
+            problems.append('%s: peak of %d bytes is above the ceiling of %d'
+                            % (name, current['peak_bytes'], ceiling))
+        if previous is None:
+            lines.append('%-26s %14.0f %14s %9s %12d %12s %9s'
+                         % (name, current['throughput'], '-', '-', current['peak_bytes'], '-', '-'))
+            continue
+
+        # Baselines recorded before the reference workload existed only
+        # have the absolute throughput
+        if 'relative' in previous:
+            speed_change = current['relative'] / previous['relative'] - 1
+        else:
+            speed_change = current['throughput'] / previous['throughput'] - 1
+        memory_change = current['peak_bytes'] / max(previous['peak_bytes'], 1) - 1
+        lines.append('%-26s %14.0f %14.0f %+8.1f%% %12d %12d %+8.1f%%'
+                     % (name, current['throughput'], previous['throughput'], 100 * speed_change,
+                        current['peak_bytes'], previous['peak_bytes'], 100 * memory_change))
+        if speed_change < -tolerance:
+            problems.append('%s is %.0f%% slower than the baseline' % (name, -100 * speed_change))
+        if memory_change > tolerance:
+            problems.append('%s uses %.0f%% more memory than the baseline' % (name, 100 * memory_change))
+    return problems, '\n'.join(lines)
+
+
+class PerfTests(unittest.TestCase):
+
+    # Tests that the pipeline is not slower or more memory-hungry than the
+    # stored baseline (and than the absolute floors and ceilings)
+    def test_performance(self, standardize, create_feature, estimate_label,
+                         get_misclassified_images, baseline_path=BASELINE_PATH,
+                         num_images=1000, tolerance=0.25, update_baseline=False):
+        image_list = synthetic_dataset(num_images)
+        results = profile_pipeline(standardize, create_feature, estimate_label,
+                                   get_misclassified_images, image_list)
+        baseline = None if update_baseline else load_baseline(baseline_path)
+        problems, table = compare(results, baseline, num_images, tolerance)
+
+        try:
+            self.assertEqual([], problems)
+        except self.failureException:
+            print_fail()
+            print('The pipeline got slower or uses more memory:')
+            print('\n'.join(problems))
+            print('\n' + table)
+            return
+
+        if baseline is None:
+            save_baseline(results, baseline_path)
+            print('Recorded a new baseline in ' + baseline_path)
+        print(table)
+        print_pass()
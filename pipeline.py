@@ -0,0 +1,214 @@
+# Pipelined execution of decode, standardize_input, create_feature and estimate_label
+#
+# The notebook runs every stage over the whole dataset before starting the
+# next one, so the CPU waits during file I/O and the disk waits during
+# classification. Pipeline connects stages with bounded queues: every stage
+# has its own worker threads and items flow through as soon as they are
+# ready, while the bounded queues keep memory use flat. Every stage records:
+#   - busy time and utilization (busy time / (workers * wall time))
+#   - input wait: time its workers sat waiting for work (upstream too slow)
+#   - output wait: time spent blocked on a full queue (downstream too slow)
+# The stage with the highest utilization is the bottleneck. When the consumer
+# of stream() stops early, every thread stops and is joined.
+#
+# Example:
+#   pipe = pipeline.classification_pipeline(standardize_input, create_feature,
+#                                           estimate_label, decode_workers=4)
+#   results = pipe.run(dataset_files.list_dataset_files(IMAGE_DIR_TEST))
+#   MISCLASSIFIED = pipeline.misclassified(results)
+#   print(pipe.format_metrics())
+
+import queue
+import threading
+import time
+
+from batch_features import index_to_one_hot
+from dataset_files import IMAGE_TYPES, read_image
+
+_DONE = object()
+
+
+class Stage(object):
+
+    # function takes one item and returns the item passed to the next stage
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.items = 0
+        self.busy = 0.0
+        self.input_wait = 0.0
+        self.output_wait = 0.0
+        self._running = self.workers
+
+    def _record(self, busy, input_wait, output_wait):
+        with self._lock:
+            self.items += 1
+            self.busy += busy
+            self.input_wait += input_wait
+            self.output_wait += output_wait
+
+    # Called by every worker when it stops; True for the last one
+    def _finished(self):
+        with self._lock:
+            self._running -= 1
+            return self._running == 0
+
+
+class Pipeline(object):
+
+    def __init__(self, stages, queue_size=64):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.elapsed = 0.0
+        self._error = None
+
+    # Put an item in the queue unless the consumer has stopped iterating
+    def _put(self, outbox, stop, item):
+        while not stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # Next item of the queue, or _DONE once the consumer has stopped iterating
+    def _get(self, inbox, stop):
+        while not stop.is_set():
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _worker(self, stage, inbox, outbox, next_workers, stop):
+        while True:
+            start = time.perf_counter()
+            item = self._get(inbox, stop)
+            got = time.perf_counter()
+            if item is _DONE:
+                break
+            index, value = item
+            try:
+                value = stage.function(value)
+            except Exception as e:
+                # Drop the item, keep draining; run() raises the first error
+                if self._error is None:
+                    self._error = e
+                continue
+            done = time.perf_counter()
+            if not self._put(outbox, stop, (index, value)):
+                break
+            stage._record(done - got, got - start, time.perf_counter() - done)
+        if stage._finished():
+            for _ in range(next_workers):
+                self._put(outbox, stop, _DONE)
+
+    # Yield (index, result) pairs as items leave the last stage; index is the
+    # position of the item in `items`
+    def stream(self, items):
+        self._error = None
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        # Set when the consumer stops iterating, so no thread stays blocked
+        # on a full queue
+        stop = threading.Event()
+        threads = []
+        for i, stage in enumerate(self.stages):
+            stage.reset()
+            next_workers = self.stages[i + 1].workers if i + 1 < len(self.stages) else 1
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self._worker,
+                                          args=(stage, queues[i], queues[i + 1], next_workers, stop))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        def feed():
+            for index, item in enumerate(items):
+                if not self._put(queues[0], stop, (index, item)):
+                    return
+            for _ in range(self.stages[0].workers):
+                self._put(queues[0], stop, _DONE)
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        start = time.perf_counter()
+        feeder.start()
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self.elapsed = time.perf_counter() - start
+            stop.set()
+            feeder.join()
+            for thread in threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
+
+    # Run every item through the pipeline and return the results in input order
+    def run(self, items):
+        items = list(items)
+        results = [None] * len(items)
+        for index, result in self.stream(items):
+            results[index] = result
+        return results
+
+    def metrics(self):
+        elapsed = max(self.elapsed, 1e-9)
+        stages = []
+        for stage in self.stages:
+            stages.append({
+                'stage': stage.name,
+                'workers': stage.workers,
+                'items': stage.items,
+                'busy_seconds': stage.busy,
+                'utilization': stage.busy / (stage.workers * elapsed),
+                'input_wait_seconds': stage.input_wait,
+                'output_wait_seconds': stage.output_wait,
+            })
+        bottleneck = max(stages, key=lambda stage: stage['utilization'])['stage'] if stages else None
+        return {'seconds': self.elapsed, 'stages': stages, 'bottleneck': bottleneck}
+
+    def format_metrics(self):
+        metrics = self.metrics()
+        lines = ['%-20s %8s %8s %12s %12s %12s' % ('stage', 'workers', 'items', 'utilization',
+                                                   'input wait', 'output wait')]
+        for stage in metrics['stages']:
+            lines.append('%-20s %8d %8d %11.1f%% %11.2fs %11.2fs' % (
+                stage['stage'], stage['workers'], stage['items'], 100 * stage['utilization'],
+                stage['input_wait_seconds'], stage['output_wait_seconds']))
+        lines.append('%.2fs, bottleneck: %s' % (metrics['seconds'], metrics['bottleneck']))
+        return '\n'.join(lines)
+
+
+# Pipeline from (path, label) pairs (dataset_files.list_dataset_files) to
+# (standardized_image, predicted_label, true_label, features) tuples, with
+# one-hot labels like the notebook's MISCLASSIFIED list
+def classification_pipeline(standardize_input, create_feature, estimate_label, decode_workers=2,
+                            standardize_workers=1, feature_workers=1, classify_workers=1,
+                            queue_size=64, read_image=read_image):
+    return Pipeline([
+        Stage('decode', lambda item: (read_image(item[0]), item[1]), decode_workers),
+        Stage('standardize_input',
+              lambda item: (standardize_input(item[0]), index_to_one_hot(IMAGE_TYPES.index(item[1]))),
+              standardize_workers),
+        Stage('create_feature', lambda item: item + (create_feature(item[0]),), feature_workers),
+        Stage('estimate_label', lambda item: (item[0], estimate_label(item[0]), item[1], item[2]),
+              classify_workers),
+    ], queue_size)
+
+
+# The (image, predicted_label, true_label) tuples of the wrongly classified
+# results of classification_pipeline
+def misclassified(results):
+    return [(image, predicted, true) for image, predicted, true, _ in results
+            if list(predicted) != list(true)]
@@ -0,0 +1,235 @@
+# Persisting predictions in bulk, off the inference thread
+#
+# A sink buffers prediction rows:
+#   (source_id, timestamp, predicted class, red, yellow, green brightness, confidence)
+# and a background thread writes them in large batches, so the classification
+# path only appends to a queue. Two backends are provided:
+#   SQLiteSink  - one SQLite table, WAL journal, executemany per transaction
+#   ColumnarSink - one columnar file per flush: Parquet when pyarrow is
+#                  installed, compressed NPZ otherwise
+# If the writer thread fails, close() (and any later hand-over of rows)
+# raises its error; the rows it had not written by then are lost.
+#
+# Example:
+#   with SQLiteSink('predictions.db') as sink:
+#       for source_id, image in frames:
+#           features = create_feature(image)
+#           label = estimate_label(image)
+#           sink.add(source_id, time.time(), label, features)
+
+import os
+import queue
+import re
+import sqlite3
+import threading
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from batch_features import CLASSES, one_hot_to_index
+
+COLUMNS = ['source_id', 'timestamp', 'predicted', 'red', 'yellow', 'green', 'confidence']
+
+
+# Base class: buffers rows and hands full batches to a writer thread.
+# Subclasses implement _open(), _write_rows(rows) and _close(), all of which
+# run on the writer thread.
+class PredictionSink(object):
+
+    def __init__(self, batch_size=10000, flush_interval=1.0, max_pending=100):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._batches = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Add one prediction. `predicted` may be a one-hot label or a class index,
+    # `features` the [red, yellow, green] output of create_feature.
+    def add(self, source_id, timestamp, predicted, features=(0.0, 0.0, 0.0), confidence=1.0):
+        if not isinstance(predicted, (int, np.integer)):
+            predicted = one_hot_to_index(predicted)
+        red, yellow, green = features
+        row = (str(source_id), float(timestamp), int(predicted),
+               float(red), float(yellow), float(green), float(confidence))
+        with self._lock:
+            self._buffer.append(row)
+            if len(self._buffer) < self.batch_size:
+                return
+            rows, self._buffer = self._buffer, []
+        self._submit(rows)
+
+    # Add many predictions at once (sequences of equal length)
+    def add_many(self, source_ids, timestamps, predicted, features, confidences=None):
+        if confidences is None:
+            confidences = np.ones(len(source_ids))
+        for row in zip(source_ids, timestamps, predicted, features, confidences):
+            self.add(*row)
+
+    # Hand an item to the writer thread. Blocks only while the writer is
+    # max_pending batches behind, and raises the writer's error instead of
+    # waiting for a writer that has died.
+    def _put(self, item):
+        while True:
+            if self._error is not None:
+                raise self._error
+            if not self._thread.is_alive():
+                raise ValueError('The sink is closed')
+            try:
+                self._batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _submit(self, rows):
+        self._put(rows)
+
+    # Hand the buffered rows to the writer thread
+    def flush(self):
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+        if rows:
+            self._submit(rows)
+
+    def _run(self):
+        try:
+            self._open()
+            while True:
+                try:
+                    rows = self._batches.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    # Nothing arrived for a while: write what is buffered
+                    with self._lock:
+                        rows, self._buffer = self._buffer, []
+                    if not rows:
+                        continue
+                if rows is None:
+                    break
+                self._write_rows(rows)
+                self.rows_written += len(rows)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._close()
+
+    # Write everything that is left and stop the writer thread. If the writer
+    # failed, its error is raised here (and the rows it had not written yet
+    # are lost).
+    def close(self):
+        if not self._thread.is_alive():
+            if self._error is not None:
+                raise self._error
+            return
+        self.flush()
+        self._put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _open(self):
+        pass
+
+    def _write_rows(self, rows):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+
+class SQLiteSink(PredictionSink):
+
+    def __init__(self, path, table='predictions', **kwargs):
+        self.path = path
+        self.table = table
+        super(SQLiteSink, self).__init__(**kwargs)
+
+    def _open(self):
+        # The connection is created and used only on the writer thread
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS %s (source_id TEXT, timestamp REAL, predicted INTEGER, '
+            'red REAL, yellow REAL, green REAL, confidence REAL)' % self.table)
+        self._connection.commit()
+
+    def _write_rows(self, rows):
+        with self._connection:
+            self._connection.executemany(
+                'INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?)' % self.table, rows)
+
+    def _close(self):
+        connection = getattr(self, '_connection', None)
+        if connection is not None:
+            connection.close()
+
+
+# Writes every batch as one columnar file in a directory:
+# part-00000.parquet (with pyarrow) or part-00000.npz. A sink opened on a
+# directory that already has parts continues their numbering.
+class ColumnarSink(PredictionSink):
+
+    def __init__(self, directory, format=None, **kwargs):
+        if format is None:
+            format = 'parquet' if pyarrow is not None else 'npz'
+        if format == 'parquet' and pyarrow is None:
+            raise ImportError('pyarrow is needed to write Parquet files')
+        self.directory = directory
+        self.format = format
+        self.parts = []
+        os.makedirs(directory, exist_ok=True)
+        numbers = [int(match.group(1)) for match in
+                   (re.match(r'part-(\d+)\.(?:parquet|npz)$', name) for name in os.listdir(directory))
+                   if match]
+        self._next_part = max(numbers) + 1 if numbers else 0
+        super(ColumnarSink, self).__init__(**kwargs)
+
+    def _columns(self, rows):
+        source_id, timestamp, predicted, red, yellow, green, confidence = zip(*rows)
+        return {
+            'source_id': np.array(source_id),
+            'timestamp': np.array(timestamp, dtype=np.float64),
+            'predicted': np.array(predicted, dtype=np.uint8),
+            'red': np.array(red, dtype=np.float32),
+            'yellow': np.array(yellow, dtype=np.float32),
+            'green': np.array(green, dtype=np.float32),
+            'confidence': np.array(confidence, dtype=np.float32),
+        }
+
+    def _write_rows(self, rows):
+        columns = self._columns(rows)
+        path = os.path.join(self.directory, 'part-%05d.%s' % (self._next_part, self.format))
+        self._next_part += 1
+        if self.format == 'parquet':
+            table = pyarrow.table(dict((name, columns[name]) for name in COLUMNS))
+            pyarrow.parquet.write_table(table, path)
+        else:
+            np.savez_compressed(path, classes=np.array(CLASSES), **columns)
+        self.parts.append(path)
+
+
+# Read all the NPZ parts written by a ColumnarSink back into one dict of columns
+def load_npz_parts(directory):
+    parts = sorted(name for name in os.listdir(directory) if name.endswith('.npz'))
+    columns = dict((name, []) for name in COLUMNS)
+    for name in parts:
+        with np.load(os.path.join(directory, name)) as data:
+            for column in COLUMNS:
+                columns[column].append(data[column])
+    return dict((name, np.concatenate(values) if values else np.array([]))
+                for name, values in columns.items())
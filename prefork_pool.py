@@ -0,0 +1,220 @@
+# Pre-forked pool of warm classifier workers
+#
+# Starting a fresh worker process means importing cv2 and NumPy again and
+# rebuilding the state derived from low_thrsh / high_thrsh and the band
+# layout, which adds seconds of cold start under burst load. PreforkPool does
+# all of that once in the parent:
+#   - loads the model (a compiled artifact, or the colour-mask LUT built in
+#     memory) and touches every page of its tables
+#   - warms it up on a dummy 32x32 image (geometry caches, cv2/NumPy code paths)
+# and then forks the workers, which inherit everything copy-on-write and
+# receive batches over pipes. The garbage collector is frozen just around
+# every fork, so the children never collect (and so copy) the inherited
+# objects while the parent keeps collecting normally. A worker is replaced by
+# a fresh fork of the warm parent after max_requests batches, which bounds
+# its memory growth. All forks are made by one spawner thread.
+#
+# Example:
+#   with prefork_pool.PreforkPool(model_path='model.tlm', num_workers=4) as pool:
+#       labels = pool.predict_batch(images)          # (N,) class indices
+#       label = pool.estimate_label(image)           # one-hot, like estimate_label
+
+import gc
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import batch_features
+import model_artifact
+
+# Bytes between touched elements when paging the tables in
+PAGE_SIZE = 4096
+
+
+def _worker(connection, model, max_requests):
+    handled = 0
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        handled += 1
+        retiring = handled >= max_requests
+        try:
+            connection.send((True, model.predict_batch(request), retiring))
+        except Exception as e:
+            connection.send((False, repr(e), retiring))
+        if retiring:
+            break
+    connection.close()
+
+
+class _Worker(object):
+
+    def __init__(self, context, model, max_requests):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_worker, args=(child_connection, model, max_requests))
+        self.process.daemon = True
+        self.process.start()
+        child_connection.close()
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join()
+        self.connection.close()
+
+
+class PreforkPool(object):
+
+    # model is anything with predict_batch(images) -> class indices, e.g. a
+    # model_artifact.ClassifierModel. Without it, the artifact at model_path
+    # is loaded, or a model with the notebook parameters is built in memory.
+    def __init__(self, model=None, model_path=None, num_workers=None, max_requests=1000,
+                 warm_size=batch_features.STANDARD_SIZE):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise RuntimeError('PreforkPool needs the fork start method')
+        if model is None:
+            model = model_artifact.load_model(model_path) if model_path else model_artifact.build_model()
+        self.model = model
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.max_requests = max_requests
+        self.recycled = 0
+        self._context = multiprocessing.get_context('fork')
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._warm(warm_size)
+        self._workers = []
+        self._idle = queue.Queue()
+        self._spawn_error = None
+        self._spawn_requests = queue.Queue()
+        self._spawner = threading.Thread(target=self._spawn_loop)
+        self._spawner.daemon = True
+        self._spawner.start()
+        # Start with every worker forked and ready
+        started = [threading.Event() for _ in range(self.num_workers)]
+        for event in started:
+            self._spawn_requests.put(event)
+        for event in started:
+            event.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _warm(self, size):
+        # Read every page of the tables so they are resident before forking
+        for table in getattr(self.model, 'tables', {}).values():
+            flat = table.reshape(-1).view(np.uint8)
+            int(flat[::PAGE_SIZE].sum())
+        self.model.predict_batch(np.zeros((1, size, size, 3), dtype=np.uint8))
+        gc.collect()
+
+    def _fork(self):
+        frozen = hasattr(gc, 'freeze')
+        if frozen:
+            # Python 3.7+: the child inherits the frozen generation, so its
+            # collector never touches the inherited objects
+            gc.freeze()
+        try:
+            return _Worker(self._context, self.model, self.max_requests)
+        finally:
+            if frozen:
+                gc.unfreeze()
+
+    # Runs on the spawner thread: forks a worker for every request (an Event
+    # that is set once the worker is ready)
+    def _spawn_loop(self):
+        while True:
+            started = self._spawn_requests.get()
+            if started is None:
+                break
+            try:
+                worker = self._fork()
+            except Exception as e:
+                self._spawn_error = e
+                # Wake up a caller waiting for a worker
+                self._idle.put(None)
+            else:
+                with self._lock:
+                    self._workers.append(worker)
+                self._idle.put(worker)
+            started.set()
+
+    def _get_worker(self):
+        worker = self._idle.get()
+        if worker is None:
+            raise RuntimeError('Could not start a worker: %r' % (self._spawn_error,))
+        return worker
+
+    def _replace(self, worker):
+        with self._lock:
+            self._workers.remove(worker)
+            closed = self._closed
+        worker.stop()
+        if not closed:
+            self.recycled += 1
+            self._spawn_requests.put(threading.Event())
+
+    # (N,) class indices of an (N, H, W, 3) uint8 batch, computed by one worker.
+    # If the worker dies the batch is retried once on another worker; `name`
+    # identifies the batch in the error raised when that one dies too.
+    def predict_batch(self, images, name=None):
+        images = np.ascontiguousarray(images)
+        for _ in range(2):
+            if self._closed:
+                raise ValueError('The pool is closed')
+            worker = self._get_worker()
+            try:
+                worker.connection.send(images)
+                ok, result, retiring = worker.connection.recv()
+                break
+            except (EOFError, OSError):
+                # The worker died: replace it
+                self._replace(worker)
+        else:
+            raise RuntimeError('Two workers died running %s'
+                               % (name or 'the batch of shape %s' % (images.shape,)))
+        if retiring:
+            self._replace(worker)
+        else:
+            self._idle.put(worker)
+        if not ok:
+            raise RuntimeError('Worker failed: ' + result)
+        return result
+
+    # Class indices of many batches, sent to all workers at once
+    def predict_many(self, batches):
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            return list(executor.map(lambda item: self.predict_batch(item[1], 'batch %d' % item[0]),
+                                     enumerate(batches)))
+
+    # Same interface as estimate_label
+    def estimate_label(self, rgb_image):
+        return batch_features.index_to_one_hot(self.predict_batch(np.asarray(rgb_image)[None])[0])
+
+    def pids(self):
+        with self._lock:
+            return [worker.process.pid for worker in self._workers]
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._spawn_requests.put(None)
+        self._spawner.join()
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            worker.stop()
@@ -0,0 +1,60 @@
+# Accuracy / throughput sweep over standard image sizes
+#
+# The brightness feature's crop and band geometry scales with the standard
+# image size (see batch_features.band_geometry), so a deployment can trade
+# accuracy for speed by choosing e.g. 16x16 or 64x64 instead of 32x32.
+# sweep() measures that trade-off on a labelled dataset.
+#
+# Example:
+#   results = resolution_sweep.sweep(TEST_IMAGE_LIST, sizes=(16, 24, 32, 48, 64))
+#   print(resolution_sweep.format_sweep(results))
+
+import time
+
+import cv2
+import numpy as np
+
+import batch_features
+from dataset_files import IMAGE_TYPES
+
+
+# Resize every image of an (image, label) list to size x size; returns an
+# (N, size, size, 3) batch and the (N,) class indices
+def standardize_batch(image_list, size=batch_features.STANDARD_SIZE):
+    images = np.empty((len(image_list), size, size, 3), dtype=np.uint8)
+    for i, (image, _) in enumerate(image_list):
+        images[i] = cv2.resize(image, (size, size))
+    labels = np.array([IMAGE_TYPES.index(label) for _, label in image_list], dtype=np.int64)
+    return images, labels
+
+
+# Accuracy, red-as-green errors and images per second (standardize + feature
+# + classify, best of `repeats` runs) for every standard size
+def sweep(image_list, sizes=(16, 24, 32, 48, 64), repeats=3):
+    results = []
+    for size in sizes:
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            images, labels = standardize_batch(image_list, size)
+            predicted = batch_features.estimate_label_batch(batch_features.brightness_features(images))
+            best = min(best, time.perf_counter() - start)
+        crop_x, crop_y, band_rows = batch_features.band_geometry(size)
+        results.append({
+            'size': size,
+            'crop_x': crop_x,
+            'crop_y': crop_y,
+            'band_rows': band_rows,
+            'accuracy': float(np.mean(predicted == labels)),
+            'red_as_green': int(np.sum((labels == 0) & (predicted == 2))),
+            'images_per_second': len(image_list) / best,
+        })
+    return results
+
+
+def format_sweep(results):
+    lines = ['%6s %10s %14s %12s' % ('size', 'accuracy', 'red as green', 'images/s')]
+    for result in results:
+        lines.append('%6d %10.4f %14d %12.0f' % (result['size'], result['accuracy'],
+                                                result['red_as_green'], result['images_per_second']))
+    return '\n'.join(lines)
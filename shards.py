@@ -0,0 +1,234 @@
+# Sharded sequential dataset format
+#
+# Reading thousands of small image files is slow on network filesystems, so a
+# dataset can be packed into a few large shard files instead. A shard is:
+#
+#   b'TLSHARD1'
+#   records: '<IBHHB' header (payload size, label index, height, width,
+#            channels) followed by the payload bytes
+#   index footer: JSON with the encoding, record offsets and labels
+#   '<Q' footer size, b'TLINDEX1'
+#
+# Payloads are either raw uint8 pixels (e.g. pre-standardized 32x32 images)
+# or PNG/JPEG encoded images. Shards are read sequentially in one pass each,
+# with the next shards prefetched by a background thread, and shards are
+# assigned to workers by rank / world size.
+
+import glob
+import json
+import os
+import queue
+import struct
+import threading
+
+import cv2
+import numpy as np
+
+from dataset_files import IMAGE_TYPES
+
+MAGIC = b'TLSHARD1'
+INDEX_MAGIC = b'TLINDEX1'
+RECORD_HEADER = struct.Struct('<IBHHB')
+FOOTER = struct.Struct('<Q')
+SHARD_SUFFIX = '.tls'
+ENCODINGS = ('raw', 'png', 'jpg')
+
+
+def _encode(image, encoding):
+    if encoding == 'raw':
+        return np.ascontiguousarray(image, dtype=np.uint8).tobytes()
+    # cv2 encodes BGR, images are kept in RGB
+    ok, data = cv2.imencode('.' + encoding, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    if not ok:
+        raise ValueError('Could not encode image as ' + encoding)
+    return data.tobytes()
+
+
+def _decode(payload, encoding, height, width, channels):
+    if encoding == 'raw':
+        # Copy so the image does not keep the whole shard buffer alive
+        return np.frombuffer(payload, dtype=np.uint8).reshape(height, width, channels).copy()
+    image = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+# Writes (image, label) pairs into numbered shard files in output_dir.
+# A function such as standardize_input can be given to store pre-standardized
+# images. If a `with` block exits with an exception, the incomplete shard is
+# deleted.
+class ShardWriter(object):
+
+    def __init__(self, output_dir, prefix='shard', images_per_shard=10000,
+                 encoding='raw', standardize_input=None):
+        if encoding not in ENCODINGS:
+            raise ValueError('Unknown encoding: ' + str(encoding))
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.images_per_shard = images_per_shard
+        self.encoding = encoding
+        self.standardize_input = standardize_input
+        self.paths = []
+        self._file = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def _open_shard(self):
+        path = os.path.join(self.output_dir, '%s-%05d%s' % (self.prefix, len(self.paths), SHARD_SUFFIX))
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._offsets = []
+        self._labels = []
+        self.paths.append(path)
+
+    def _close_shard(self):
+        index = json.dumps({'encoding': self.encoding,
+                            'offsets': self._offsets,
+                            'labels': self._labels}).encode('utf-8')
+        self._file.write(index)
+        self._file.write(FOOTER.pack(len(index)))
+        self._file.write(INDEX_MAGIC)
+        self._file.close()
+        self._file = None
+
+    def write(self, image, label):
+        if self.standardize_input is not None:
+            image = self.standardize_input(image)
+        if self._file is None:
+            self._open_shard()
+        height, width = image.shape[:2]
+        channels = image.shape[2] if image.ndim == 3 else 1
+        payload = _encode(image, self.encoding)
+
+        self._offsets.append(self._file.tell())
+        self._labels.append(label)
+        self._file.write(RECORD_HEADER.pack(len(payload), IMAGE_TYPES.index(label),
+                                            height, width, channels))
+        self._file.write(payload)
+        if len(self._offsets) >= self.images_per_shard:
+            self._close_shard()
+
+    def close(self):
+        if self._file is not None:
+            self._close_shard()
+
+    # Stop writing and delete the shard being written, which has no index yet
+    # (the shards already completed are kept)
+    def abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self.paths.pop())
+
+
+# Write a list of (image, label) pairs, like the output of
+# helpers.load_dataset, into shards. Returns the shard paths.
+def write_shards(image_list, output_dir, **kwargs):
+    with ShardWriter(output_dir, **kwargs) as writer:
+        for image, label in image_list:
+            writer.write(image, label)
+    return writer.paths
+
+
+# Read the index footer of a shard: {'encoding', 'offsets', 'labels'}
+def read_index(path):
+    with open(path, 'rb') as f:
+        f.seek(-(FOOTER.size + len(INDEX_MAGIC)), os.SEEK_END)
+        size, = FOOTER.unpack(f.read(FOOTER.size))
+        if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError('Not a complete shard file: ' + path)
+        f.seek(-(size + FOOTER.size + len(INDEX_MAGIC)), os.SEEK_END)
+        return json.loads(f.read(size).decode('utf-8'))
+
+
+# Decode every (image, label) record of a shard held in memory
+def parse_shard(data):
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a shard file')
+    size, = FOOTER.unpack_from(data, len(data) - FOOTER.size - len(INDEX_MAGIC))
+    index_start = len(data) - FOOTER.size - len(INDEX_MAGIC) - size
+    encoding = json.loads(bytes(data[index_start:index_start + size]).decode('utf-8'))['encoding']
+
+    view = memoryview(data)
+    position = len(MAGIC)
+    while position < index_start:
+        length, label, height, width, channels = RECORD_HEADER.unpack_from(data, position)
+        position += RECORD_HEADER.size
+        image = _decode(view[position:position + length], encoding, height, width, channels)
+        position += length
+        yield image, IMAGE_TYPES[label]
+
+
+# Shard files of a directory (or a list of paths) that belong to one worker
+def assign_shards(shards, rank=0, world_size=1):
+    if isinstance(shards, str):
+        shards = glob.glob(os.path.join(shards, '*' + SHARD_SUFFIX))
+    return sorted(shards)[rank::world_size]
+
+
+# Streams the (image, label) pairs of this worker's shards. Every shard is
+# read with one sequential read, and up to `prefetch` shards are read ahead by
+# a background thread while the current one is being consumed.
+class ShardReader(object):
+
+    def __init__(self, shards, rank=0, world_size=1, prefetch=2):
+        self.paths = assign_shards(shards, rank, world_size)
+        self.prefetch = prefetch
+
+    def __len__(self):
+        return sum(len(read_index(path)['offsets']) for path in self.paths)
+
+    # Put an item in the queue unless the consumer has stopped iterating
+    def _put(self, buffers, stop, item):
+        while not stop.is_set():
+            try:
+                buffers.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read_ahead(self, buffers, stop):
+        try:
+            for path in self.paths:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if not self._put(buffers, stop, data):
+                    return
+        except Exception as e:
+            self._put(buffers, stop, e)
+            return
+        self._put(buffers, stop, None)
+
+    def __iter__(self):
+        buffers = queue.Queue(maxsize=max(1, self.prefetch))
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read_ahead, args=(buffers, stop))
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                data = buffers.get()
+                if data is None:
+                    break
+                if isinstance(data, Exception):
+                    raise data
+                for item in parse_shard(data):
+                    yield item
+        finally:
+            stop.set()
+            reader.join()
+
+
+# Load every (image, label) pair of this worker's shards into a list, the
+# same format returned by helpers.load_dataset
+def load_shards(shards, rank=0, world_size=1):
+    return list(ShardReader(shards, rank, world_size))
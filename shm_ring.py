@@ -0,0 +1,182 @@
+# Shared-memory ring buffer for passing frames to classifier workers
+#
+# Sending images through multiprocessing queues pickles and copies every frame.
+# FrameRing keeps a fixed number of frame slots in one shared memory block: a
+# capture process writes each frame straight into a slot and classifier
+# workers read it as a NumPy view, so only the small sequence counters are
+# synchronized between processes.
+#
+# Shared memory layout:
+#   header: int64[3]  head (next sequence to write), tail (next sequence to
+#                     read), closed flag
+#   state:  int64[num_slots]  FREE / WRITING / READY / READING
+#   tags:   int64[num_slots]  caller-defined id of the frame in each slot
+#   frames: uint8[num_slots, *frame_shape]
+#
+# When every slot is in use the producer blocks until a worker releases one
+# (backpressure), instead of buffering frames without limit.
+#
+# Example:
+#   ring = FrameRing(num_slots=64)
+#   workers = [multiprocessing.Process(target=shm_ring.classify_frames,
+#                                      args=(ring, estimate_label, results))
+#              for _ in range(4)]
+#   ...
+#   ring.write(standardize_input(frame), tag=frame_number)
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+FREE = 0
+WRITING = 1
+READY = 2
+READING = 3
+
+_HEAD = 0
+_TAIL = 1
+_CLOSED = 2
+
+
+class FrameRing(object):
+
+    def __init__(self, num_slots=64, frame_shape=(32, 32, 3), condition=None):
+        self.num_slots = num_slots
+        self.frame_shape = tuple(frame_shape)
+        frame_size = int(np.prod(self.frame_shape))
+        size = 8 * (3 + 2 * num_slots) + frame_size * num_slots
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        self._owner = True
+        self._condition = condition if condition is not None else multiprocessing.Condition()
+        self._attach()
+        self._header[:] = 0
+        self._state[:] = FREE
+
+    def _attach(self):
+        n = self.num_slots
+        buf = self._shm.buf
+        self._header = np.ndarray((3,), dtype=np.int64, buffer=buf)
+        self._state = np.ndarray((n,), dtype=np.int64, buffer=buf, offset=8 * 3)
+        self._tags = np.ndarray((n,), dtype=np.int64, buffer=buf, offset=8 * (3 + n))
+        self._frames = np.ndarray((n,) + self.frame_shape, dtype=np.uint8, buffer=buf,
+                                  offset=8 * (3 + 2 * n))
+
+    # Only the shared memory name and the condition are sent to child processes
+    def __getstate__(self):
+        return {'name': self._shm.name, 'num_slots': self.num_slots,
+                'frame_shape': self.frame_shape, 'condition': self._condition}
+
+    def __setstate__(self, state):
+        self.num_slots = state['num_slots']
+        self.frame_shape = state['frame_shape']
+        self._condition = state['condition']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        self._attach()
+
+    @property
+    def written(self):
+        return int(self._header[_HEAD])
+
+    @property
+    def read(self):
+        return int(self._header[_TAIL])
+
+    # Number of frames written but not yet picked up by a worker
+    def pending(self):
+        with self._condition:
+            return int(self._header[_HEAD] - self._header[_TAIL])
+
+    # Reserve the next slot for writing. Blocks while the slot is still in use
+    # (backpressure). Returns (sequence, writable view), or None on timeout.
+    def acquire_write(self, timeout=None):
+        with self._condition:
+            seq = int(self._header[_HEAD])
+            slot = seq % self.num_slots
+            if not self._condition.wait_for(lambda: self._state[slot] == FREE, timeout):
+                return None
+            self._state[slot] = WRITING
+            self._header[_HEAD] = seq + 1
+        return seq, self._frames[slot]
+
+    # Publish a slot filled after acquire_write
+    def commit_write(self, seq, tag=0):
+        slot = seq % self.num_slots
+        with self._condition:
+            self._tags[slot] = tag
+            self._state[slot] = READY
+            self._condition.notify_all()
+
+    # Copy one frame into the ring. Returns False if no slot became free in time.
+    def write(self, frame, tag=0, timeout=None):
+        reserved = self.acquire_write(timeout)
+        if reserved is None:
+            return False
+        seq, view = reserved
+        view[...] = frame
+        self.commit_write(seq, tag)
+        return True
+
+    # Take the next frame. Returns (sequence, tag, read-only view), or None if
+    # the ring is closed and drained or the timeout expired. The view stays
+    # valid until release(sequence) is called.
+    def acquire_read(self, timeout=None):
+        with self._condition:
+            def ready():
+                tail = self._header[_TAIL]
+                if tail < self._header[_HEAD] and self._state[tail % self.num_slots] == READY:
+                    return True
+                return self._header[_CLOSED] and tail >= self._header[_HEAD]
+            if not self._condition.wait_for(ready, timeout):
+                return None
+            seq = int(self._header[_TAIL])
+            if seq >= self._header[_HEAD]:
+                return None
+            slot = seq % self.num_slots
+            self._state[slot] = READING
+            self._header[_TAIL] = seq + 1
+            tag = int(self._tags[slot])
+        view = self._frames[slot].view()
+        view.flags.writeable = False
+        return seq, tag, view
+
+    # Give a slot back to the producer
+    def release(self, seq):
+        with self._condition:
+            self._state[seq % self.num_slots] = FREE
+            self._condition.notify_all()
+
+    # Yield (tag, view) for every frame until the ring is closed and drained;
+    # each slot is released when the consumer asks for the next frame
+    def frames(self):
+        while True:
+            item = self.acquire_read()
+            if item is None:
+                return
+            seq, tag, view = item
+            try:
+                yield tag, view
+            finally:
+                self.release(seq)
+
+    # Tell the workers that no more frames will be written
+    def close_writer(self):
+        with self._condition:
+            self._header[_CLOSED] = 1
+            self._condition.notify_all()
+
+    # Detach from the shared memory (and free it, in the creating process)
+    def close(self):
+        self._header = self._state = self._tags = self._frames = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+# Classifier worker loop: classify every frame of the ring in place and put
+# (tag, one-hot label) results on a queue
+def classify_frames(ring, estimate_label, results):
+    for tag, frame in ring.frames():
+        results.put((tag, estimate_label(frame)))
+    results.put(None)
@@ -0,0 +1,186 @@
+# Scheduling frames from many camera streams onto one classifier
+#
+# Every registered stream gets a bounded queue. When a queue is full the
+# oldest frame is dropped (a newer frame of the same light is more useful),
+# and frames whose deadline has passed are dropped instead of being
+# classified late. The surviving frames are taken from the streams with
+# weighted round robin (deficit round robin), so one busy camera cannot starve
+# the others, and each batch goes through standardize_input and a batched
+# feature + classification step.
+#
+# Example:
+#   scheduler = StreamScheduler(standardize_input)
+#   scheduler.register('camera-1', max_queue=4, max_age=0.2)
+#   scheduler.submit('camera-1', frame)        # from the capture threads
+#   results = scheduler.run_once()             # from the classifier thread
+#   print(scheduler.stats())
+
+import collections
+import threading
+import time
+
+import numpy as np
+
+import batch_features
+
+
+# Default batch classifier: vectorized brightness feature + estimate_label rules
+def classify_brightness(images):
+    features = batch_features.brightness_features(images)
+    return [batch_features.index_to_one_hot(i) for i in batch_features.estimate_label_batch(features)]
+
+
+class _Stream(object):
+
+    def __init__(self, max_queue, weight, max_age):
+        self.queue = collections.deque()
+        self.max_queue = max_queue
+        self.weight = weight
+        self.max_age = max_age
+        self.deficit = 0.0
+        self.submitted = 0
+        self.served = 0
+        self.dropped_overflow = 0
+        self.dropped_deadline = 0
+        self.last_latency = 0.0
+
+
+class StreamScheduler(object):
+
+    # classify_batch takes an (N, H, W, 3) batch of standardized images and
+    # returns N one-hot labels. To use a per-image function such as
+    # estimate_label, pass estimate_label=... instead.
+    def __init__(self, standardize_input, classify_batch=None, estimate_label=None,
+                 batch_size=32, clock=time.monotonic):
+        if classify_batch is None:
+            if estimate_label is not None:
+                classify_batch = lambda images: [estimate_label(im) for im in images]
+            else:
+                classify_batch = classify_brightness
+        self.standardize_input = standardize_input
+        self.classify_batch = classify_batch
+        self.batch_size = batch_size
+        self.clock = clock
+        self._streams = collections.OrderedDict()
+        self._order = []
+        self._next = 0
+        self._condition = threading.Condition()
+
+    # max_queue bounds the frames waiting for this stream, weight is its share
+    # of the classifier (must be positive), and max_age (seconds) is the
+    # default frame deadline
+    def register(self, stream_id, max_queue=8, weight=1.0, max_age=None):
+        if not weight > 0:
+            raise ValueError('Stream weight must be positive, got ' + str(weight))
+        with self._condition:
+            self._streams[stream_id] = _Stream(max_queue, weight, max_age)
+            self._order = list(self._streams)
+
+    def unregister(self, stream_id):
+        with self._condition:
+            del self._streams[stream_id]
+            self._order = list(self._streams)
+
+    # Queue a frame. Returns False if an older frame had to be dropped to make room.
+    def submit(self, stream_id, frame, deadline=None, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock()
+        with self._condition:
+            stream = self._streams[stream_id]
+            if deadline is None and stream.max_age is not None:
+                deadline = timestamp + stream.max_age
+            stream.submitted += 1
+            accepted = True
+            if len(stream.queue) >= stream.max_queue:
+                stream.queue.popleft()
+                stream.dropped_overflow += 1
+                accepted = False
+            stream.queue.append((timestamp, deadline, frame))
+            self._condition.notify()
+        return accepted
+
+    # Drop the queued frames whose deadline has passed
+    def _expire(self, stream, now):
+        kept = collections.deque()
+        for item in stream.queue:
+            if item[1] is not None and item[1] < now:
+                stream.dropped_deadline += 1
+            else:
+                kept.append(item)
+        stream.queue = kept
+
+    # Take up to batch_size frames with deficit round robin over the streams.
+    # Returns a list of (stream_id, timestamp, frame).
+    def next_batch(self, batch_size=None):
+        if batch_size is None:
+            batch_size = self.batch_size
+        batch = []
+        with self._condition:
+            now = self.clock()
+            for stream in self._streams.values():
+                self._expire(stream, now)
+            if not self._order:
+                return batch
+            while len(batch) < batch_size:
+                if not any(stream.queue for stream in self._streams.values()):
+                    break
+                stream_id = self._order[self._next % len(self._order)]
+                self._next += 1
+                stream = self._streams[stream_id]
+                if not stream.queue:
+                    stream.deficit = 0.0
+                    continue
+                stream.deficit += stream.weight
+                while stream.deficit >= 1 and stream.queue and len(batch) < batch_size:
+                    stream.deficit -= 1
+                    timestamp, _, frame = stream.queue.popleft()
+                    batch.append((stream_id, timestamp, frame))
+                if not stream.queue:
+                    stream.deficit = 0.0
+        return batch
+
+    # Classify one batch. Returns a list of (stream_id, timestamp, label).
+    def run_once(self, batch_size=None):
+        batch = self.next_batch(batch_size)
+        if not batch:
+            return []
+        images = np.stack([self.standardize_input(frame) for _, _, frame in batch])
+        labels = self.classify_batch(images)
+
+        now = self.clock()
+        results = []
+        with self._condition:
+            for (stream_id, timestamp, _), label in zip(batch, labels):
+                stream = self._streams.get(stream_id)
+                if stream is not None:
+                    stream.served += 1
+                    stream.last_latency = now - timestamp
+                results.append((stream_id, timestamp, label))
+        return results
+
+    # Keep classifying batches until stop (a threading.Event) is set, passing
+    # each batch of results to on_results
+    def run(self, on_results, stop, idle_timeout=0.05):
+        while not stop.is_set():
+            with self._condition:
+                if not any(stream.queue for stream in self._streams.values()):
+                    self._condition.wait(idle_timeout)
+                    continue
+            results = self.run_once()
+            if results:
+                on_results(results)
+
+    # Per-stream counters. 'lag' is the age of the oldest queued frame and
+    # 'latency' the time from submission to classification of the last frame.
+    def stats(self):
+        now = self.clock()
+        with self._condition:
+            return dict((stream_id, {
+                'queued': len(stream.queue),
+                'submitted': stream.submitted,
+                'served': stream.served,
+                'dropped_overflow': stream.dropped_overflow,
+                'dropped_deadline': stream.dropped_deadline,
+                'lag': now - stream.queue[0][0] if stream.queue else 0.0,
+                'latency': stream.last_latency,
+            }) for stream_id, stream in self._streams.items())
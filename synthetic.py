@@ -0,0 +1,186 @@
+# Synthetic traffic light images and a load-testing driver
+#
+# Benchmarks should not depend on the traffic_light_images dataset being
+# available. generate_batch() draws labelled crops of a traffic light (a dark
+# housing with three lamps, one of them lit, over a noisy background) for a
+# whole batch at once with NumPy broadcasting, so millions of images can be
+# produced quickly. generate() returns variable-size crops in the same
+# (image, label) format as helpers.load_dataset.
+#
+# LoadDriver replays images into the classification pipeline at a fixed rate
+# and reports the sustained throughput and the latency percentiles.
+#
+# Example:
+#   IMAGE_LIST = synthetic.generate(10000, seed=0)
+#   driver = synthetic.LoadDriver(synthetic.pipeline(standardize_input, estimate_label),
+#                                 rate=5000, num_workers=4)
+#   print(driver.run([image for image, _ in IMAGE_LIST]))
+
+import concurrent.futures
+import threading
+import time
+
+import numpy as np
+
+from dataset_files import IMAGE_TYPES
+
+# Lit lamp colours (RGB) for red, yellow and green lights
+LAMP_COLOURS = np.array([[255, 50, 40], [255, 200, 40], [60, 255, 150]], dtype=np.float32)
+
+# Largest number of images drawn at once (bounds the float32 intermediates)
+CHUNK_SIZE = 1024
+
+
+def _generate_chunk(n, height, width, labels, rng):
+    yy = np.arange(height, dtype=np.float32)[None, :, None]
+    xx = np.arange(width, dtype=np.float32)[None, None, :]
+
+    def per_image(low, high):
+        return rng.uniform(low, high, (n, 1, 1)).astype(np.float32)
+
+    # Housing: a dark box that fills most of the crop, with random margins,
+    # over a background of random colour
+    top = per_image(0.0, 0.12) * height
+    bottom = height - per_image(0.0, 0.12) * height
+    left = per_image(0.05, 0.25) * width
+    right = width - per_image(0.05, 0.25) * width
+    housing = (yy >= top) & (yy < bottom) & (xx >= left) & (xx < right)
+    background = rng.uniform(40, 200, (n, 1, 1, 3)).astype(np.float32)
+    housing_colour = rng.uniform(10, 50, (n, 1, 1, 1)).astype(np.float32)
+    images = np.where(housing[..., None], housing_colour, background)
+
+    # Three lamps stacked vertically in the housing, each inside its own third
+    # of it, so the lamp a pixel belongs to only depends on its row and the
+    # blend factor is one single-channel pass over the batch
+    centre_x = (left + right) / 2
+    section = (bottom - top) / 3
+    radius = np.minimum(right - left, section) * per_image(0.28, 0.42)
+    outer = radius ** 2
+    # Soft edge: the last 20% of the radius fades into the housing
+    inner = (0.8 * radius) ** 2
+    lamp_index = np.clip(np.floor((yy - top) / section), 0, 2).astype(np.intp)
+    centre_y = top + (lamp_index + 0.5) * section
+    distance = (yy - centre_y) ** 2 + (xx - centre_x) ** 2
+    fade = np.clip((outer - distance) / (outer - inner), 0, 1)
+
+    # Colour of each lamp of each image: only the labelled lamp is lit, the
+    # others are a dim version of their colour
+    brightness = rng.uniform(0.6, 1.0, (n, 1, 1)).astype(np.float32)
+    lit = (np.arange(3)[None, :] == labels[:, None])[..., None]
+    lamp_colours = LAMP_COLOURS[None] * brightness * np.where(lit, 1.0, 0.2).astype(np.float32)
+    lamp_index += 3 * np.arange(n)[:, None, None]
+    lamp_pixels = np.take(lamp_colours.reshape(-1, 3), lamp_index, axis=0) - images
+    lamp_pixels *= fade[..., None]
+    images += lamp_pixels
+
+    # Overall exposure and uniform sensor noise in [-10, 10)
+    images *= per_image(0.5, 1.3)[..., None]
+    noise = rng.random(images.shape, dtype=np.float32)
+    noise -= 0.5
+    noise *= 20
+    images += noise
+    return np.clip(images, 0, 255, out=images).astype(np.uint8)
+
+
+# An (N, height, width, 3) uint8 batch of synthetic crops and their (N,) class
+# indices (0 red, 1 yellow, 2 green). Labels are drawn at random unless given.
+def generate_batch(num_images, height=64, width=32, labels=None, seed=None, rng=None):
+    if rng is None:
+        rng = np.random.default_rng(seed)
+    if labels is None:
+        labels = rng.integers(0, 3, num_images)
+    labels = np.asarray(labels)
+    images = np.empty((num_images, height, width, 3), dtype=np.uint8)
+    for start in range(0, num_images, CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, num_images)
+        images[start:end] = _generate_chunk(end - start, height, width, labels[start:end], rng)
+    return images, labels
+
+
+# Yield (images, labels) batches until total images have been produced
+def iter_batches(total, batch_size=CHUNK_SIZE, height=64, width=32, seed=None):
+    rng = np.random.default_rng(seed)
+    for start in range(0, total, batch_size):
+        yield generate_batch(min(batch_size, total - start), height, width, rng=rng)
+
+
+# A list of (image, label) pairs with crops of different sizes, like the
+# output of helpers.load_dataset. Sizes are rounded to multiples of `step`
+# so each size can be drawn as one batch.
+def generate(num_images, min_size=(32, 16), max_size=(128, 64), step=8, seed=None):
+    rng = np.random.default_rng(seed)
+    heights = rng.integers(min_size[0] // step, max_size[0] // step + 1, num_images) * step
+    widths = rng.integers(min_size[1] // step, max_size[1] // step + 1, num_images) * step
+    image_list = [None] * num_images
+    for height, width in set(zip(heights, widths)):
+        indices = np.flatnonzero((heights == height) & (widths == width))
+        images, labels = generate_batch(len(indices), height, width, rng=rng)
+        for i, image, label in zip(indices, images, labels):
+            image_list[i] = (image, IMAGE_TYPES[label])
+    return image_list
+
+
+# Batch classification function for LoadDriver built from the notebook functions
+def pipeline(standardize_input, estimate_label):
+    return lambda frames: [estimate_label(standardize_input(frame)) for frame in frames]
+
+
+# Replays frames into a classification function at a fixed rate (open loop)
+# and measures how long each batch takes from the moment it was due to be
+# sent, so queueing delays under overload show up in the latencies.
+class LoadDriver(object):
+
+    # classify takes a list of frames and returns their labels. rate is in
+    # frames per second (None sends as fast as possible).
+    def __init__(self, classify, rate=None, batch_size=1, num_workers=1):
+        self.classify = classify
+        self.rate = rate
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+
+    def run(self, frames, duration=None):
+        latencies = []
+        lock = threading.Lock()
+        batches = [frames[start:start + self.batch_size]
+                   for start in range(0, len(frames), self.batch_size)]
+        interval = self.batch_size / float(self.rate) if self.rate else 0.0
+
+        def send(batch, due):
+            self.classify(batch)
+            latency = time.perf_counter() - due
+            with lock:
+                latencies.extend([latency] * len(batch))
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(self.num_workers) as executor:
+            futures = []
+            for i, batch in enumerate(batches):
+                due = start + i * interval
+                if duration is not None and due - start > duration:
+                    break
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(executor.submit(send, batch, due))
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+
+        result = {
+            'frames': len(latencies),
+            'seconds': elapsed,
+            'offered_rate': self.rate,
+            'throughput': len(latencies) / elapsed,
+            'latency_p50': None,
+            'latency_p95': None,
+            'latency_p99': None,
+            'latency_max': None,
+        }
+        # Without frames there are no latencies to report
+        if latencies:
+            latencies = np.array(latencies)
+            result['latency_p50'] = float(np.percentile(latencies, 50))
+            result['latency_p95'] = float(np.percentile(latencies, 95))
+            result['latency_p99'] = float(np.percentile(latencies, 99))
+            result['latency_max'] = float(latencies.max())
+        return result
@@ -0,0 +1,30 @@
+# PASSED / FAILED output shared by the test modules (perf_tests, array_tests)
+#
+# In the notebook the results are rendered as coloured Markdown like the
+# tests in test_functions.py; elsewhere (even with IPython installed) they
+# are printed as plain text.
+
+import re
+
+try:
+    import IPython
+    from IPython.display import Markdown, display
+except ImportError:
+    IPython = None
+
+
+# Markdown in a notebook (an IPython kernel), plain text without the
+# emphasis and HTML tags anywhere else (scripts, build machines)
+def printmd(string):
+    if IPython is not None and IPython.get_ipython() is not None:
+        display(Markdown(string))
+    else:
+        print(re.sub(r'<[^>]*>', '', string).replace('*', ''))
+
+
+def print_fail():
+    printmd('**<span style="color: red;">TEST FAILED</span>**')
+
+
+def print_pass():
+    printmd('**<span style="color: green;">TEST PASSED</span>**')
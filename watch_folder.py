@@ -0,0 +1,262 @@
+# Long-running watcher that classifies images as they arrive in a folder tree
+#
+# Uploaders drop crops into directories such as traffic_light_images/test/red/.
+# FolderWatcher classifies only the files it has not seen before, in batches,
+# through standardize_input, create_feature and estimate_label, and records
+# every processed file in a checkpoint so a restart does not process it again.
+# A file that still cannot be decoded after max_read_attempts tries without
+# changing is recorded in the checkpoint as failed and not read again.
+#
+# New files are detected with inotify on Linux (through ctypes, no extra
+# dependency) and with a polling scan elsewhere. The polling scan only lists
+# directories whose modification time changed since the previous scan.
+#
+# Example:
+#   watcher = FolderWatcher('traffic_light_images/test/', standardize_input,
+#                           create_feature, estimate_label, 'watch_checkpoint.json',
+#                           sink=prediction_sink.SQLiteSink('predictions.db'))
+#   watcher.run()
+
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from dataset_files import read_image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+_EVENT = struct.Struct('iIII')
+
+
+# Minimal inotify wrapper, or None when inotify is not available
+class _Inotify(object):
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+
+    @staticmethod
+    def create():
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            return _Inotify()
+        except (OSError, AttributeError):
+            return None
+
+    def watch(self, directory):
+        wd = self._add_watch(self.fd, os.fsencode(directory),
+                             IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if wd >= 0:
+            self.directories[wd] = directory
+
+    # Wait up to timeout seconds; returns (path, is_directory) events
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        position = 0
+        while position < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, position)
+            position += _EVENT.size
+            name = data[position:position + length].rstrip(b'\0')
+            position += length
+            directory = self.directories.get(wd)
+            if directory is not None and name:
+                events.append((os.path.join(directory, os.fsdecode(name)), bool(mask & IN_ISDIR)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher(object):
+
+    # create_feature may be None if only the labels are needed. Results go to
+    # on_results(list of (path, predicted_label, features)) and/or to a
+    # prediction_sink sink.
+    def __init__(self, root, standardize_input, create_feature, estimate_label,
+                 checkpoint_path, on_results=None, sink=None, batch_size=64,
+                 poll_interval=1.0, settle_time=1.0, use_inotify=True, max_read_attempts=3):
+        self.root = os.path.abspath(root)
+        self.standardize_input = standardize_input
+        self.create_feature = create_feature
+        self.estimate_label = estimate_label
+        self.checkpoint_path = checkpoint_path
+        self.on_results = on_results
+        self.sink = sink
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.use_inotify = use_inotify
+        self.max_read_attempts = max_read_attempts
+        self.processed = self._load_checkpoint()
+        self._directory_mtimes = {}
+        self._pending = set()
+        # Failed reads of every path: (attempts, [mtime_ns, size])
+        self._read_failures = {}
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path) as f:
+            return json.load(f)
+
+    # Write the checkpoint to a temporary file and rename it into place
+    def save_checkpoint(self):
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.processed, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    # Checkpoint entries are [mtime_ns, size], or [mtime_ns, size, 'failed']
+    # for files that could not be decoded; a changed file is new again
+    def _is_new(self, entry_path, stat):
+        relative = os.path.relpath(entry_path, self.root)
+        entry = self.processed.get(relative)
+        return entry is None or entry[:2] != [stat.st_mtime_ns, stat.st_size]
+
+    # Files recorded as failed in the checkpoint (relative paths)
+    def failed(self):
+        return sorted(path for path, entry in self.processed.items() if entry[2:] == ['failed'])
+
+    # Count a failed read; returns True once the file should be given up on
+    def _read_failed(self, path, stat):
+        signature = [stat.st_mtime_ns, stat.st_size]
+        attempts, previous = self._read_failures.get(path, (0, signature))
+        # Attempts only add up while the file does not change
+        attempts = attempts + 1 if previous == signature else 1
+        if attempts < self.max_read_attempts:
+            self._read_failures[path] = (attempts, signature)
+            return False
+        del self._read_failures[path]
+        self.processed[os.path.relpath(path, self.root)] = signature + ['failed']
+        return True
+
+    # Scan the tree and return the new image files. Directories whose mtime is
+    # unchanged are not listed again, unless full is True.
+    def scan(self, full=False):
+        new_files = []
+        stack = [self.root]
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            unchanged = self._directory_mtimes.get(directory) == mtime
+            self._directory_mtimes[directory] = mtime
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif (not unchanged or full) and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        stat = entry.stat()
+                        if self._is_new(entry.path, stat):
+                            new_files.append(entry.path)
+        # Files that were still being written last time are checked again
+        return sorted(set(new_files) | self._pending)
+
+    # Classify a list of files in batches; returns the number classified
+    def process(self, paths):
+        count = 0
+        now = time.time()
+        for start in range(0, len(paths), self.batch_size):
+            results = []
+            gave_up = False
+            for path in paths[start:start + self.batch_size]:
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    self._pending.discard(path)
+                    continue
+                if not self._is_new(path, stat):
+                    self._pending.discard(path)
+                    continue
+                # Leave files that may still be being written for later
+                if now - stat.st_mtime < self.settle_time:
+                    self._pending.add(path)
+                    continue
+                try:
+                    image = read_image(path)
+                except IOError:
+                    if self._read_failed(path, stat):
+                        self._pending.discard(path)
+                        gave_up = True
+                    else:
+                        self._pending.add(path)
+                    continue
+                self._pending.discard(path)
+                self._read_failures.pop(path, None)
+
+                standard_im = self.standardize_input(image)
+                features = self.create_feature(standard_im) if self.create_feature else (0.0, 0.0, 0.0)
+                predicted = self.estimate_label(standard_im)
+                results.append((path, predicted, features))
+                self.processed[os.path.relpath(path, self.root)] = [stat.st_mtime_ns, stat.st_size]
+
+            if results:
+                if self.sink is not None:
+                    for path, predicted, features in results:
+                        self.sink.add(os.path.relpath(path, self.root), now, predicted, features)
+                if self.on_results is not None:
+                    self.on_results(results)
+                count += len(results)
+            if results or gave_up:
+                self.save_checkpoint()
+        return count
+
+    # Classify everything new once, then keep watching until stop is set
+    def run(self, stop=None):
+        if stop is None:
+            stop = threading.Event()
+        inotify = _Inotify.create() if self.use_inotify else None
+        try:
+            if inotify is not None:
+                for directory, _, _ in os.walk(self.root):
+                    inotify.watch(directory)
+            # Catch up with everything that arrived while the watcher was not running
+            self.process(self.scan(full=True))
+            while not stop.is_set():
+                if inotify is None:
+                    stop.wait(self.poll_interval)
+                    self.process(self.scan())
+                    continue
+                paths = []
+                for path, is_directory in inotify.read(self.poll_interval):
+                    if is_directory:
+                        inotify.watch(path)
+                        # Files may have landed before the watch was added
+                        for sub_directory, _, files in os.walk(path):
+                            inotify.watch(sub_directory)
+                            paths.extend(os.path.join(sub_directory, name) for name in files
+                                         if name.lower().endswith(IMAGE_EXTENSIONS))
+                    elif path.lower().endswith(IMAGE_EXTENSIONS):
+                        paths.append(path)
+                self.process(sorted(set(paths) | self._pending))
+        finally:
+            if inotify is not None:
+                inotify.close()